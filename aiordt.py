@@ -0,0 +1,392 @@
+"""
+aiordt.py
+
+An asyncio implementation of the RDT protocol in rdt.py. It uses the same
+wire formats and interoperates with rdt.Rdt peers, but runs on one event loop
+with a single datagram endpoint and loop-driven retransmission timers, so a
+process can run thousands of concurrent transfers without threads.
+"""
+
+import asyncio
+import queue
+import socket
+import threading
+
+import metrics
+import rdt
+
+
+class RdtDatagramProtocol(asyncio.DatagramProtocol):
+    """
+    Passes datagrams received on the endpoint to its AsyncRdt.
+
+    """
+    def __init__(self, owner):
+        self.owner = owner
+
+    def datagram_received(self, data, address):
+        self.owner.datagram_received(data, address)
+
+    def error_received(self, exc):
+        # ICMP errors such as port unreachable; retransmission handles them
+        pass
+
+
+class AsyncPeerState(rdt.PeerState):
+    """
+    PeerState of the asyncio transport. Sends to the same peer are serialized
+    by an asyncio lock.
+
+    """
+    def __init__(self, estimated_RTT, dev_RTT, timeout_interval, congestion=None):
+        rdt.PeerState.__init__(self, estimated_RTT, dev_RTT, timeout_interval, congestion)
+        self.lock = asyncio.Lock()
+
+
+class AsyncRdt(rdt.RdtBase):
+    """
+    RDT over an asyncio datagram endpoint. Data packets are sent from, and
+    ACKs received on, the same endpoint that receives messages; ACKs are
+    matched to the packets awaiting them by source IP address, comm_id and
+    seq. (rdt.Rdt peers send their ACKs from another port than the one they
+    receive data on, so the port is not compared.)
+
+    """
+    def __init__(self, hostname, window_size=1, wire_format="text", mtu=rdt.LEGACY_MTU,
+                 ack_every=1, message_queue_size=1024):
+        """
+        Initialize default values.
+
+        Arguments:
+        hostname, window_size, wire_format, mtu, ack_every -- as for
+            rdt.RdtBase.
+        message_queue_size -- as for rdt.Rdt.
+
+        """
+        rdt.RdtBase.__init__(self, hostname, window_size, wire_format, mtu, ack_every)
+        self.transport = None
+        self.reaper = None
+        self.ack_timer = None
+        self.message_queue = asyncio.Queue(message_queue_size)
+        # Sender state for each destination address
+        self.peers = {}
+        # (IP address, comm_id) -> {seq: future resolved with the flags of its ACK}
+        self.pending = {}
+        # The ACKs of every transfer arrive on the one endpoint socket, so it
+        # asks for a larger receive buffer (capped by the kernel's rmem_max)
+        self.rcvbuf = 4 * 1024 * 1024
+
+    async def start_server(self, port=0):
+        """
+        Opens the datagram endpoint. Must be called before send; a port of 0
+        picks an ephemeral port for a process that only sends.
+
+        Arguments:
+        port -- The port number to listen on.
+
+        """
+        loop = asyncio.get_running_loop()
+        self.transport, protocol = await loop.create_datagram_endpoint(
+            lambda: RdtDatagramProtocol(self), local_addr=('0.0.0.0', port))
+        sock = self.transport.get_extra_info('socket')
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        metrics.registry.gauge("rdt_message_queue_depth", lambda: self.message_queue.qsize())
+        self.reaper = loop.call_later(self.reap_interval, self.reap_periodically)
+
+    def reap_periodically(self):
+        """
+        Calls reap every reap_interval seconds on the event loop.
+
+        """
+        self.reap()
+        loop = asyncio.get_running_loop()
+        self.reaper = loop.call_later(self.reap_interval, self.reap_periodically)
+
+    def sendto(self, data, address):
+        self.transport.sendto(data, address)
+
+    def schedule_ack_flush(self):
+        if self.ack_timer is None:
+            loop = asyncio.get_running_loop()
+            self.ack_timer = loop.call_later(self.ack_delay, self.flush_acks_periodically)
+
+    def flush_acks_periodically(self):
+        """
+        Sends due delayed ACKs, and checks again after ack_delay while any
+        remain pending.
+
+        """
+        self.ack_timer = None
+        if self.flush_due_acks():
+            self.schedule_ack_flush()
+
+    def deliver(self, message):
+        self.message_queue.put_nowait(message)
+
+    def accepting_messages(self):
+        return not self.message_queue.full()
+
+    def datagram_received(self, data, address):
+        """
+        Dispatches a received datagram: ACKs complete the future of the packet
+        they acknowledge, anything else is processed as a data packet.
+
+        """
+        try:
+            header, payload = self.extract(data)
+            if header is None:
+                return
+
+            if "ACK" in header[3]:
+                outstanding = self.pending.get((address[0], header[1]))
+                if outstanding:
+                    for seq in self.acked_seqs(header, payload, header[1], outstanding):
+                        ack = outstanding[seq]
+                        if not ack.done():
+                            ack.set_result(header[3])
+            else:
+                self.process_fragment(header, payload, address, data[0] == rdt.BINARY_MAGIC)
+        except Exception:
+            # Drop malformed packets
+            return
+
+    def get_peer(self, address):
+        """
+        Returns the AsyncPeerState for the given destination address, creating
+        it on first use.
+
+        """
+        peer = self.peers.get(address)
+        if peer is None:
+            peer = AsyncPeerState(self.estimated_RTT, self.dev_RTT, self.timeout_interval,
+                                  self.congestion_control())
+            self.peers[address] = peer
+
+        return peer
+
+    def release_sender(self, address):
+        """
+        Forgets the AsyncPeerState for address. Called when the peer is known
+        to have gone away.
+
+        """
+        self.peers.pop(address, None)
+
+    async def send(self, comm_id, data, address):
+        """
+        Sends a message encoded as UTF-8 with send_bytes.
+
+        Arguments:
+        comm_id -- The communication ID associated with this message.
+        data -- the (unencoded) upper-layer data to transmit.
+        address -- the destination IP address/FQDN and port passed as a
+                   2-tuple.
+
+        Returns:
+        True if upper-layer data was sent successfully, else returns False.
+
+        """
+        return await self.send_bytes(comm_id, data.encode(), address)
+
+    async def send_bytes(self, comm_id, data, address):
+        """
+        Sends a message given as a bytes-like object, keeping up to
+        window_size packets in flight. As with rdt.Rdt, the SYN and FIN
+        packets are sent with an otherwise empty window.
+
+        Arguments:
+        comm_id, address -- as for send.
+        data -- the upper-layer data to transmit. It must not be modified
+                until send_bytes returns.
+
+        Returns:
+        True if upper-layer data was sent successfully, else returns False.
+
+        """
+        address = await self.resolve(address)
+        peer = self.get_peer(address)
+        async with peer.lock:
+            in_flight = set()
+            try:
+                for header, packet in self.make_packets(peer, comm_id, data):
+                    barrier = header[3] != ""
+                    limit = 0 if barrier else peer.window(self.window_size) - 1
+                    if not await self.wait_window(in_flight, limit):
+                        return False
+                    in_flight.add(asyncio.ensure_future(
+                        self.send_packet(peer, header, packet, address)))
+                    if barrier and not await self.wait_window(in_flight, 0):
+                        return False
+
+                return await self.wait_window(in_flight, 0)
+            finally:
+                for task in in_flight:
+                    task.cancel()
+
+    async def resolve(self, address):
+        """
+        Returns address with its host as a numeric IPv4 address, the form in
+        which the source address of each ACK is reported.
+
+        """
+        try:
+            socket.inet_pton(socket.AF_INET, address[0])
+            return address
+        except OSError:
+            loop = asyncio.get_running_loop()
+            infos = await loop.getaddrinfo(address[0], address[1], family=socket.AF_INET,
+                                           type=socket.SOCK_DGRAM)
+
+            return infos[0][4]
+
+    async def wait_window(self, in_flight, limit):
+        """
+        Waits until at most limit packets are in flight.
+
+        Returns:
+        False if any packet that finished could not be delivered, else True.
+
+        """
+        while len(in_flight) > limit:
+            done, pending = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            in_flight.difference_update(done)
+            if not all(task.result() for task in done):
+                return False
+
+        return True
+
+    async def send_packet(self, peer, header, packet, address):
+        """
+        Transmits a single packet until it is ACKed or has been sent
+        max_retries times. The datagram transport has no scatter-gather send,
+        so the header and payload buffers are joined first.
+
+        Returns:
+        True if the packet was ACKed, else returns False.
+
+        """
+        loop = asyncio.get_running_loop()
+        packet = b"".join(packet)
+        seq = int(header[2])
+        ack = loop.create_future()
+        key = (address[0], header[1])
+        outstanding = self.pending.setdefault(key, {})
+        outstanding[seq] = ack
+        try:
+            for attempt in range(self.max_retries):
+                delay = peer.pacing_delay()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                start_time = loop.time()
+                self.transport.sendto(packet, address)
+                peer.on_send(attempt > 0)
+                timeout = peer.timeout_interval
+                try:
+                    flags = await asyncio.wait_for(asyncio.shield(ack), timeout)
+                except asyncio.TimeoutError:
+                    # Transmission timed-out. The packets of a lost window
+                    # all time out together; back off once for the event,
+                    # not once per packet, as rdt.Rdt.await_ack does.
+                    if timeout == peer.timeout_interval:
+                        peer.on_timeout()
+                    continue
+
+                if attempt == 0:
+                    # Only sample packets that were never retransmitted
+                    peer.update_RTT(loop.time() - start_time)
+                peer.on_ack(1)
+                if rdt.BINARY_CAPABLE in flags:
+                    peer.binary = True
+                return True
+
+            return False
+        finally:
+            del outstanding[seq]
+            if not outstanding:
+                del self.pending[key]
+
+    def peer_stats(self):
+        """
+        Returns a dict mapping each destination address to the statistics of
+        its AsyncPeerState.
+
+        """
+        return {address: peer.stats() for address, peer in self.peers.items()}
+
+    async def receive(self):
+        """
+        Waits for and returns the next reassembled message, decoded from UTF-8.
+
+        """
+        return (await self.receive_bytes()).decode()
+
+    async def receive_bytes(self):
+        """
+        Waits for and returns the next reassembled message as bytes.
+
+        """
+        return await self.message_queue.get()
+
+    def close(self):
+        """
+        Closes the datagram endpoint.
+
+        """
+        if self.reaper is not None:
+            self.reaper.cancel()
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+        if self.transport is not None:
+            self.transport.close()
+
+
+class ThreadedAsyncRdt(object):
+    """
+    Blocking front end to AsyncRdt with the interface of rdt.Rdt, so that the
+    threaded client and server can run on the asyncio transport. The event
+    loop runs in its own thread.
+
+    """
+    def __init__(self, hostname, window_size=1, wire_format="text", mtu=rdt.LEGACY_MTU,
+                 ack_every=1, message_queue_size=1024):
+        self.loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self.loop.run_forever, args=())
+        thread.daemon = True
+        thread.start()
+        self.rdt = AsyncRdt(hostname, window_size, wire_format, mtu, ack_every,
+                            message_queue_size)
+        # Deliver messages to a thread-safe queue instead of an asyncio one
+        self.rdt.message_queue = queue.Queue(message_queue_size)
+
+    def run(self, coro):
+        """
+        Runs a coroutine on the event loop and waits for its result.
+
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def start_server(self, port):
+        self.run(self.rdt.start_server(port))
+
+    def send(self, comm_id, data, address):
+        return self.run(self.rdt.send(comm_id, data, address))
+
+    def send_bytes(self, comm_id, data, address):
+        return self.run(self.rdt.send_bytes(comm_id, data, address))
+
+    def release_sender(self, address):
+        self.loop.call_soon_threadsafe(self.rdt.release_sender, address)
+
+    def receive_data(self):
+        """
+        Called by upper layer to receive messages from the queue.
+
+        """
+        return self.receive_bytes().decode()
+
+    def receive_bytes(self):
+        return self.rdt.message_queue.get(True, 5)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.rdt.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
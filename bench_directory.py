@@ -0,0 +1,119 @@
+"""
+bench_directory.py
+
+Measures QUERY latency of the directory server's backends at a large number
+of shared files: SQLite with and without its trigram substring index, and the
+in-memory directory, along with the memory it uses per entry. The directory is
+filled through server.database_add and queried through server.database_query;
+the SQLite database is built in a scratch file.
+
+Usage:
+python bench_directory.py [--rows 1000000] [--hosts 100] [--repeat 20] [--backend both]
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import dbpool
+import directory
+import server
+
+
+SEARCHES = ["song 12345", "SONG 99", "mix", "zz_no_match_zz", "Live at"]
+
+
+def fill(rows, hosts):
+    """
+    Shares rows files, spread over hosts hosts, through database_add.
+
+    Returns:
+    The number of seconds it took.
+
+    """
+    words = ["song", "Live at", "mix", "demo", "remaster", "track", "intro"]
+    rng = random.Random(1)
+    per_host = rows // hosts
+    start = time.perf_counter()
+    for host in range(hosts):
+        body = ['"{} {} {}.mp3" {}'.format(rng.choice(words), rng.randrange(10 ** 6),
+                                           host * per_host + i, rng.randrange(10 ** 7))
+                for i in range(per_host)]
+        server.database_add("host{}".format(host), "10.0.{}.{}".format(host // 256, host % 256),
+                            body)
+
+    return time.perf_counter() - start
+
+
+def time_queries(repeat):
+    """
+    Returns, for each search in SEARCHES, its median latency in milliseconds
+    and its number of matches.
+
+    """
+    results = {}
+    for search in SEARCHES:
+        times = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            matches = server.database_query("client", [search + " "])
+            times.append(time.perf_counter() - start)
+        times.sort()
+        results[search] = {"median_ms": times[len(times) // 2] * 1e3, "matches": len(matches)}
+
+    return results
+
+
+def bench_sqlite(args):
+    with tempfile.TemporaryDirectory() as scratch:
+        server.dbname = os.path.join(scratch, "bench.db")
+        server.db = dbpool.ConnectionManager(server.dbname, server.db_lock)
+        server.file_directory = directory.SqliteDirectory(server.db)
+        server.init_database()
+        results = {"fts": server.file_directory.fts_enabled,
+                   "fill_seconds": fill(args.rows, args.hosts),
+                   "file_bytes": os.path.getsize(server.dbname)}
+        if server.file_directory.fts_enabled:
+            results["indexed"] = time_queries(args.repeat)
+            server.file_directory.fts_enabled = False
+        results["scan"] = time_queries(args.repeat)
+        server.file_directory.close()
+
+    return results
+
+
+def bench_memory(args):
+    server.file_directory = directory.MemoryDirectory()
+    tracemalloc.start()
+    results = {"fill_seconds": fill(args.rows, args.hosts)}
+    # The file lists parsed during fill have been freed; what remains is
+    # the directory itself
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    results["bytes_per_entry"] = used / args.rows
+    results["estimated_bytes_per_entry"] = server.file_directory.memory_usage() / args.rows
+    results["indexed"] = time_queries(args.repeat)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Directory query benchmark")
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--hosts", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--backend", choices=["sqlite", "memory", "both"], default="both")
+    args = parser.parse_args()
+
+    results = {"rows": args.rows}
+    if args.backend in ("sqlite", "both"):
+        results["sqlite"] = bench_sqlite(args)
+    if args.backend in ("memory", "both"):
+        results["memory"] = bench_memory(args)
+
+    print(json.dumps(results, indent=2))
+    os._exit(0)
@@ -0,0 +1,234 @@
+"""
+bench_rdt.py
+
+Throughput and latency benchmarks for rdt.Rdt. A sender and a receiver run in
+this process and talk over localhost through a lossyrelay.LossyRelay, which
+can inject loss, reordering, duplication and delay. For each message size it
+reports goodput, retransmissions, p50/p99 message latency and CPU seconds per
+MB, plus micro-benchmarks of make_packets and process_pkt, as JSON.
+
+Usage:
+python bench_rdt.py [--sizes 40,1024,65536,4194304] [--loss 0.01] [--output results.json]
+"""
+
+import argparse
+import json
+import platform
+import queue
+import threading
+import time
+
+import clientmsg
+import rdt
+from lossyrelay import LossyRelay
+
+
+def make_message(size):
+    """
+    Returns a message of about size bytes: an IDENT for tiny sizes, else an
+    INFORM listing as many files as fit.
+
+    """
+    msg = clientmsg.ClientMsg("bench", "127.0.0.1")
+    msg.ident()
+    message = repr(msg)
+    if size <= len(message):
+        return message
+
+    head = "INFORM bench 127.0.0.1\r\n"
+    lines = []
+    length = len(head) + 2
+    i = 0
+    while length < size:
+        line = "\"file{:08d}.dat\" {}\r\n".format(i, 1000 + i)
+        lines.append(line)
+        length += len(line)
+        i += 1
+
+    return (head + "".join(lines) + "\r\n")[:size]
+
+
+def percentile(values, fraction):
+    """
+    Returns the nearest-rank percentile of values, or None if it is empty.
+
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))
+
+    return values[index]
+
+
+def receiver_thread(receiver, arrivals, stop):
+    """
+    Records the arrival time of each message, keyed by the index that
+    prefixes it.
+
+    """
+    while not stop.is_set():
+        try:
+            message = receiver.receive_data()
+        except queue.Empty:
+            continue
+        arrivals.put((int(message[:8]), time.perf_counter(), len(message)))
+
+
+def run_case(size, count, args):
+    """
+    Sends count messages of size bytes through a relay, one after the other.
+
+    Returns:
+    A dict of the results for this size.
+
+    """
+    receiver = rdt.Rdt("bench-receiver", args.window, args.wire_format, args.mtu,
+                       args.workers, args.ack_every)
+    receiver.start_server(0)
+    receiver_port = receiver.listen_sock.getsockname()[1]
+    relay = LossyRelay(("127.0.0.1", receiver_port), 0, args.loss, args.duplicate,
+                       args.reorder, args.delay, args.jitter, seed=args.seed)
+    relay.start()
+    sender = rdt.Rdt("bench-sender", args.window, args.wire_format, args.mtu,
+                     args.workers, args.ack_every)
+    address = ("127.0.0.1", relay.port)
+    arrivals = queue.Queue()
+    stop = threading.Event()
+    thread = threading.Thread(target=receiver_thread, args=(receiver, arrivals, stop))
+    thread.daemon = True
+    thread.start()
+
+    # Warm up, which also negotiates the binary format
+    comm_id = 1
+    while not sender.send(comm_id, "{:08d}".format(0), address) and comm_id < 10:
+        comm_id += 1
+    arrivals.get(True, 10)
+    before = sender.peer_stats().get(address, {})
+
+    payload = make_message(max(size - 8, 1))
+    sent = {}
+    failures = 0
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for i in range(1, count + 1):
+        start = time.perf_counter()
+        if sender.send(comm_id + i, "{:08d}".format(i) + payload, address):
+            sent[i] = start
+        else:
+            failures += 1
+
+    latencies = []
+    received_bytes = 0
+    deadline = time.perf_counter() + 10
+    while len(latencies) < len(sent) and time.perf_counter() < deadline:
+        try:
+            index, arrival, length = arrivals.get(True, 0.1)
+        except queue.Empty:
+            continue
+        if index in sent:
+            latencies.append(arrival - sent[index])
+            received_bytes += length
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    after = sender.peer_stats().get(address, {})
+    stop.set()
+    sender.close()
+    relay.close()
+    receiver.close()
+
+    megabytes = received_bytes / 1e6
+    p50 = percentile(latencies, 0.50)
+    p99 = percentile(latencies, 0.99)
+
+    return {"size": size,
+            "messages": count,
+            "delivered": len(latencies),
+            "failed": failures,
+            "seconds": wall,
+            "goodput_MBps": megabytes / wall if wall else None,
+            "latency_p50_ms": p50 * 1e3 if latencies else None,
+            "latency_p99_ms": p99 * 1e3 if latencies else None,
+            "packets_sent": after.get("packets_sent", 0) - before.get("packets_sent", 0),
+            "retransmits": after.get("retransmits", 0) - before.get("retransmits", 0),
+            "timeouts": after.get("timeouts", 0) - before.get("timeouts", 0),
+            "cwnd": after.get("cwnd"),
+            "cpu_seconds_per_MB": cpu / megabytes if megabytes else None,
+            "relay": relay.stats()}
+
+
+def run_micro(size, args):
+    """
+    Times make_packets and process_pkt on one message of size bytes, without
+    any sockets in the way.
+
+    Returns:
+    A dict of the results.
+
+    """
+    rdt_instance = rdt.Rdt("bench", args.window, args.wire_format, args.mtu,
+                           args.workers, args.ack_every)
+    # ACKs are built but not sent
+    rdt_instance.sendto = lambda data, address: None
+    sender = rdt.PeerState(0.1, 0, 1.0)
+    sender.binary = args.wire_format == "binary"
+    data = make_message(size)
+    size = len(data)
+
+    start = time.perf_counter()
+    packets = [b"".join(packet)
+               for header, packet in rdt_instance.make_packets(sender, 1, data.encode())]
+    make_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for packet in packets:
+        rdt_instance.process_pkt(packet, ("127.0.0.1", 9))
+    process_seconds = time.perf_counter() - start
+    delivered = rdt_instance.message_queue.get_nowait() == data.encode()
+    rdt_instance.close()
+
+    return {"size": size,
+            "packets": len(packets),
+            "make_packets_MBps": size / 1e6 / make_seconds,
+            "process_pkt_MBps": size / 1e6 / process_seconds,
+            "process_pkt_us_per_packet": process_seconds / len(packets) * 1e6,
+            "reassembled": delivered}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RDT benchmarks")
+    parser.add_argument("--sizes", default="40,1024,65536,1048576,4194304",
+                        help="comma-separated message sizes in bytes")
+    parser.add_argument("--count", type=int, default=20,
+                        help="messages per size; sizes over 1 MB send a quarter as many")
+    parser.add_argument("--window", type=int, default=8)
+    parser.add_argument("--wire-format", default="binary", choices=["text", "binary"])
+    parser.add_argument("--mtu", type=int, default=1400)
+    parser.add_argument("--ack-every", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--loss", type=float, default=0.0)
+    parser.add_argument("--duplicate", type=float, default=0.0)
+    parser.add_argument("--reorder", type=float, default=0.0)
+    parser.add_argument("--delay", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON results to this file")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    results = {"python": platform.python_version(),
+               "config": vars(args),
+               "transfers": [],
+               "micro": []}
+    for size in sizes:
+        count = args.count if size <= 1 << 20 else max(1, args.count // 4)
+        results["transfers"].append(run_case(size, count, args))
+        results["micro"].append(run_micro(size, args))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
@@ -15,8 +15,12 @@ from _thread import interrupt_main
 import sys
 import queue
 import shlex
+import argparse
+import mmap
+import time
 
 import rdt
+import aiordt
 import clientmsg
 
 
@@ -34,12 +38,29 @@ default_udp_listen_port = 60001
 default_share = "mp3"
 # List of files shared with the directory server
 shared_files = []
+# Number of RDT packets kept in flight per message sent to the server
+rdt_window_size = 8
+# Use the compact binary RDT header if the server supports it
+rdt_wire_format = "binary"
+# RDT payload size per packet if the server supports large datagrams
+rdt_mtu = 1400
+# Acknowledge in-order binary packets with one cumulative ACK per this many
+rdt_ack_every = 4
+# Bytes read per call when sending a file without os.sendfile
+send_chunk_size = 256 * 1024
+# Largest number of bytes received per call when downloading a file
+recv_chunk_size = 256 * 1024
+# Receive downloads straight into a memory map of the output file, sized up
+# front, instead of through a buffer
+download_mmap = False
+# Longest HTTP request or response header accepted from a peer
+MAX_HEADER_SIZE = 8192
 
 hostname = socket.gethostname()
 # Append a random 16-bit hex string to the hostname
 host_id = hostname + "{:04x}".format(random.randrange(0xffff))
 # Instantiate instance of Rdt class
-r = rdt.Rdt(host_id)
+r = rdt.Rdt(host_id, rdt_window_size, rdt_wire_format, rdt_mtu, ack_every=rdt_ack_every)
 # Each message corresponds to a unique comm_id
 comm_id = random.randrange(MAX_COMM_ID)
 # Queue to hold response messages from directory server
@@ -48,6 +69,12 @@ msg_queue = queue.Queue()
 connected = False
 # Most recent query response from server
 current_query = []
+# Number of query results fetched from the server at a time
+query_page_size = 50
+# Search string and hostname of the most recent query, and the total number
+# of results it matched
+current_search = None
+current_query_total = 0
 # For thread-safe I/O
 stdout_lock = threading.Lock()
 
@@ -91,6 +118,8 @@ def usage():
         print("connect [addr port]\tConnects to the server at the specified")
         print("\t\t\tIP address and port. Uses localhost 60001 if not specified.")
         print("")
+        print("more\t\t\tFetches the next page of results of the last query.")
+        print("")
         print("share [dirname]\t\tInforms the server of the availability of mp3")
         print("\t\t\tfiles to share in the path specified by [dirname].")
         print("\t\t\tDefaults to the current path if not specified.")
@@ -136,6 +165,12 @@ def stdin_listener():
             else:
                 with stdout_lock:
                     print("***Invalid input!")
+        elif kybd_in[0] == "more":
+            if len(kybd_in) == 1:
+                query_more()
+            else:
+                with stdout_lock:
+                    print("***Invalid input!")
         elif kybd_in[0] == "get":
             if len(kybd_in) == 2:
                 get(kybd_in[1])
@@ -222,8 +257,23 @@ def share(shared_dir):
 
 
 def query(search_string, hostname=''):
+    global current_search, current_query
+    current_search = (search_string, hostname)
+    current_query = []
+    fetch_query_page(0)
+
+
+def query_more():
+    if current_search is None or len(current_query) >= current_query_total:
+        with stdout_lock:
+            print("No more results for the current query.")
+    else:
+        fetch_query_page(len(current_query))
+
+
+def fetch_query_page(offset):
     if connected:
-        msg.query(search_string, hostname)
+        msg.query(current_search[0], current_search[1], query_page_size, offset)
         with stdout_lock:
             print("==>Sending QUERY message to server.")
         msg_queue.queue.clear()
@@ -237,7 +287,7 @@ def query(search_string, hostname=''):
                 with stdout_lock:
                     print("\t-->Received QUERY response from server.")
                 process_query_response(response[2])
-                print_current_query()
+                print_current_query(offset)
             else:   # bad response
                 with stdout_lock:
                     print("\t-->Failed to receive QUERY response from server.")
@@ -250,22 +300,41 @@ def query(search_string, hostname=''):
 
 
 def process_query_response(query_response):
-    global current_query
-    current_query = []
-    for i in range(0, len(query_response), 2):
+    """
+    Appends a page of query results to current_query.
+
+    Arguments:
+    query_response -- The value lines of a QUERYRESPONSE. A paged response
+                      starts with an "<offset> <total>" line; a server that
+                      does not page sends every result at once.
+
+    """
+    global current_query, current_query_total
+    start = len(query_response) % 2
+    if start:
+        offset, total = query_response[0].split(' ')
+        del current_query[int(offset):]
+        current_query_total = int(total)
+    for i in range(start, len(query_response), 2):
         host_id, ip_addr = query_response[i].split(' ')
         filename = query_response[i+1].split(' ')
         filesize = filename[-1]
         filename = ' '.join(filename[:-1])
         current_query.append((host_id, ip_addr, filename, filesize))
+    if not start:
+        current_query_total = len(current_query)
 
 
-def print_current_query():
+def print_current_query(start=0):
     if len(current_query) != 0:
-        for i, line in enumerate(current_query):
+        for i, line in enumerate(current_query[start:], start):
             with stdout_lock:
                 print("[{}]: {}\nFilesize: {}\tHost ID: {}\tIP Address: {}".
                       format(i, line[2], line[3], line[0], line[1]))
+        if len(current_query) < current_query_total:
+            with stdout_lock:
+                print("Showing {} of {} results. Type more for the next {}.".
+                      format(len(current_query), current_query_total, query_page_size))
     else:   # no items returned in query response
         with stdout_lock:
             print("No items found which match your query.")
@@ -289,6 +358,34 @@ def stuff():
         r.close()
 
 
+def read_http_header(conn):
+    """
+    Reads an HTTP request or response header from a peer.
+
+    Returns:
+    A (start_line, headers, rest) tuple, where headers maps each lowercased
+    header name to its value and rest holds any bytes received after the
+    header, or None if the connection closed or the header is too long.
+
+    """
+    data = b""
+    while b"\r\n\r\n" not in data:
+        if len(data) > MAX_HEADER_SIZE:
+            return None
+        chunk = conn.recv(4096)
+        if not chunk:
+            return None
+        data += chunk
+    header, rest = data.split(b"\r\n\r\n", 1)
+    lines = header.decode().split("\r\n")
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    return (lines[0], headers, rest)
+
+
 def get(query_index):
     query_index = int(query_index)
     if query_index >= len(current_query):
@@ -299,50 +396,155 @@ def get(query_index):
         with stdout_lock:
             print(req_file)
         get_msg = "GET {} HTTP/1.1\r\n\r\n".format(req_file[2])
-        # "HTTP/1.1 200 OK\r\nContent-Length: {}\r\n\r\n".format(filelength)
-        # if content-length != database file length: FAILED!
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.connect((req_file[1], p2p_server_port))
         s.send(get_msg.encode())
-        #data = s.recv(BUFFER_SIZE)
-        writefile = open(req_file[2], 'wb')
         with stdout_lock:
             print("Waiting for file...")
-        length = int(req_file[3])
-        data = s.recv(min(1024, length))
-        writefile.write(data)
-        length -= len(data)
+        response = read_http_header(s)
+        if response is None or response[0].split(" ")[1:2] != ["200"]:
+            s.close()
+            with stdout_lock:
+                print("\t-->Peer could not send the file: {}".
+                      format(response[0] if response else "no response"))
+            return
+        status_line, headers, data = response
+        expected = int(req_file[3])
+        length = int(headers.get("content-length", expected))
+        if length != expected:
+            with stdout_lock:
+                print("\t-->Warning: peer is sending {} bytes, the server listed {}.".
+                      format(length, expected))
         with stdout_lock:
             print("Receiving file...")
-        while(length > 0):
-            data = s.recv(min(1024, length))
-            writefile.write(data)
-            length -= len(data)
-        s.close()
+        start = time.perf_counter()
+        try:
+            received = receive_file(s, req_file[2], length, data)
+        finally:
+            s.close()
+        seconds = time.perf_counter() - start
         with stdout_lock:
-            print("File download complete!")
+            if received != length:
+                print("\t-->Download failed: connection closed {} bytes short.".
+                      format(length - received))
+            elif received != expected:
+                print("\t-->Download failed: received {} bytes, the server listed {}.".
+                      format(received, expected))
+            else:
+                print("File download complete! {} bytes in {:.2f}s ({:.2f} MB/s)".
+                      format(received, seconds, received / 1e6 / seconds if seconds else 0))
+
+
+def receive_file(conn, filename, length, data=b""):
+    """
+    Receives a file of length bytes from conn into filename, recv_chunk_size
+    bytes at a time, with recv_into into a buffer allocated once or, with
+    download_mmap set, into a memory map of the file.
+
+    Arguments:
+    data -- bytes of the file already received with the response header.
+
+    Returns:
+    The number of bytes received. The file is truncated to that size if the
+    connection closed early.
+
+    """
+    data = data[:length]
+    received = len(data)
+    with open(filename, 'w+b') as writefile:
+        if download_mmap and length > 0:
+            writefile.truncate(length)
+            with mmap.mmap(writefile.fileno(), length) as mapped, memoryview(mapped) as view:
+                view[:received] = data
+                while received < length:
+                    with view[received:] as rest:
+                        read = conn.recv_into(rest, min(recv_chunk_size, length - received))
+                    if not read:
+                        break
+                    received += read
+            if received < length:
+                writefile.truncate(received)
+        else:
+            writefile.write(data)
+            view = memoryview(bytearray(recv_chunk_size))
+            while received < length:
+                read = conn.recv_into(view, min(recv_chunk_size, length - received))
+                if not read:
+                    break
+                writefile.write(view[:read])
+                received += read
+
+    return received
+
+
+def stream_file(conn, sendfile, size):
+    """
+    Sends size bytes of an open file to conn without holding more than
+    send_chunk_size bytes of it in memory: with os.sendfile where the
+    platform has it, else by reading it into one reused buffer.
+
+    """
+    if hasattr(os, "sendfile"):
+        conn.sendfile(sendfile, 0, size)
+        return
+    buffer = bytearray(send_chunk_size)
+    view = memoryview(buffer)
+    while size > 0:
+        read = sendfile.readinto(view[:min(size, send_chunk_size)])
+        if not read:
+            break
+        conn.sendall(view[:read])
+        size -= read
 
 
 def send_file(conn, addr):
     with stdout_lock:
         print("==>Connected by peer {}".format(addr))
-    data = conn.recv(1024)
-    if data:
-        data = data.decode()
+    try:
+        request = read_http_header(conn)
+        if request is None:
+            return
+        request_line = request[0]
         with stdout_lock:
-            print("\t-->Peer request: {}".format(data))
-        data = data.split(" ")
+            print("\t-->Peer request: {}".format(request_line))
+        data = request_line.split(" ")
         method = data[0]
         version = data[-1]
         filename = ' '.join(data[1:-1])
-        sendfile = open(filename, 'rb')
-        with stdout_lock:
-            print("\t-->Sending file to peer {}".format(addr))
-        filedata = sendfile.read()
-        conn.sendall(filedata)
-        conn.close()
+        # Only serve files that have been shared
+        if method != "GET" or filename not in [file[0] for file in shared_files]:
+            conn.sendall("{} 404 Not Found\r\nContent-Length: 0\r\n\r\n".format(version).encode())
+            with stdout_lock:
+                print("\t-->Peer {} requested a file that is not shared.".format(addr))
+            return
+        sendfile = None
+        try:
+            sendfile = open(filename, 'rb')
+            size = os.fstat(sendfile.fileno()).st_size
+        except OSError as e:
+            # Shared, but since deleted or made unreadable
+            if sendfile is not None:
+                sendfile.close()
+            if isinstance(e, FileNotFoundError):
+                status = "404 Not Found"
+            else:
+                status = "500 Internal Server Error"
+            conn.sendall("{} {}\r\nContent-Length: 0\r\n\r\n".format(version, status).encode())
+            with stdout_lock:
+                print("\t-->Could not open {} for peer {}: {}".format(filename, addr, e))
+            return
+        with sendfile:
+            conn.sendall("HTTP/1.1 200 OK\r\nContent-Length: {}\r\n\r\n".format(size).encode())
+            with stdout_lock:
+                print("\t-->Sending file to peer {}".format(addr))
+            stream_file(conn, sendfile, size)
         with stdout_lock:
             print("\t-->File transfer complete!")
+    except OSError as e:
+        with stdout_lock:
+            print("\t-->File transfer to peer {} failed: {}".format(addr, e))
+    finally:
+        conn.close()
 
 
 def tcp_listener():
@@ -399,16 +601,25 @@ def start_client(server_ip=default_server_host, server_prt=default_server_port,
 if __name__ == "__main__":
     """
     Usage:
-        python3 client.py [server_ip [server_port [p2p_server_port [udp_listen_port]]]]
+        python3 client.py [--asyncio] [server_ip [server_port [p2p_server_port [udp_listen_port]]]]
 
     """
-    if len(sys.argv) == 5:
-        start_client(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
-    elif len(sys.argv) == 4:
-        start_client(sys.argv[1], sys.argv[2], sys.argv[3])
-    elif len(sys.argv) == 3:
-        start_client(sys.argv[1], sys.argv[2])
-    elif len(sys.argv) == 2:
-        start_client(sys.argv[1])
-    else:
-        start_client()
+    parser = argparse.ArgumentParser(description="P2P client.")
+    parser.add_argument("server_ip", nargs="?", default=default_server_host)
+    parser.add_argument("server_port", nargs="?", default=default_server_port)
+    parser.add_argument("p2p_server_port", nargs="?", default=default_p2p_server_port)
+    parser.add_argument("udp_listen_port", nargs="?", default=default_udp_listen_port)
+    parser.add_argument("--asyncio", action="store_true",
+                        help="run the RDT layer on the asyncio transport")
+    parser.add_argument("--recv-chunk", type=int, default=recv_chunk_size,
+                        help="bytes received per call when downloading a file")
+    parser.add_argument("--mmap-downloads", action="store_true",
+                        help="receive downloads directly into a memory-mapped file")
+    args = parser.parse_args()
+    recv_chunk_size = max(1, args.recv_chunk)
+    download_mmap = args.mmap_downloads
+    if args.asyncio:
+        r.close()
+        r = aiordt.ThreadedAsyncRdt(host_id, rdt_window_size, rdt_wire_format, rdt_mtu,
+                                    rdt_ack_every)
+    start_client(args.server_ip, args.server_port, args.p2p_server_port, args.udp_listen_port)
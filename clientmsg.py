@@ -37,7 +37,7 @@ class ClientMsg(object):
         for file in file_list:
             self.body = "{}{} {}\r\n".format(self.body, file[0], file[1])
 
-    def query(self, search_string, hostname=""):
+    def query(self, search_string, hostname="", limit=None, offset=0):
         """
         Query message.
 
@@ -49,10 +49,15 @@ class ClientMsg(object):
                          quoted).
 
         hostname -- Hostname of the specific client to search, if specified.
+        limit -- Largest number of results to return, if the results are to
+                 be paged.
+        offset -- Number of results to skip, when paging.
 
         """
         self.method = "QUERY"
         self.body = "{} {}\r\n".format(search_string, hostname)
+        if limit is not None:
+            self.body = "{}{} {}\r\n".format(self.body, limit, offset)
 
     def remove(self, file_list):
         """
@@ -0,0 +1,117 @@
+"""
+dbpool.py
+
+Persistent SQLite connections for the directory server: one writer connection
+and a pool of reader connections to the same database file in WAL mode, so
+that queries read a consistent snapshot while an INFORM is being written
+instead of waiting for it. Connections are opened once and keep their
+prepared statement caches across requests.
+"""
+
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+# Applied to every connection. cache_size is in KiB when negative.
+DEFAULT_PRAGMAS = [("journal_mode", "WAL"),
+                   ("synchronous", "NORMAL"),
+                   ("cache_size", -16384),
+                   ("mmap_size", 268435456),
+                   ("temp_store", "MEMORY"),
+                   ("busy_timeout", 5000)]
+
+
+class ConnectionManager(object):
+    """
+    Hands out the writer connection, one thread at a time, and reader
+    connections from a pool. Connections are opened on first use.
+
+    """
+    def __init__(self, path, lock=None, readers=4, pragmas=None, cached_statements=256):
+        """
+        Arguments:
+        path -- the database file. WAL mode needs a file, so ":memory:" is
+                not supported.
+        lock -- the lock serializing use of the writer connection. A new
+                lock is created if None.
+        readers -- largest number of reader connections.
+        pragmas -- (name, value) pairs applied to every connection, in
+                   place of DEFAULT_PRAGMAS.
+        cached_statements -- size of each connection's prepared statement
+                             cache.
+
+        """
+        self.path = path
+        self.lock = lock if lock is not None else threading.Lock()
+        self.max_readers = max(1, readers)
+        self.pragmas = pragmas if pragmas is not None else DEFAULT_PRAGMAS
+        self.cached_statements = cached_statements
+        self.write_conn = None
+        self.readers = queue.Queue()
+        self.reader_conns = []
+        self.readers_lock = threading.Lock()
+
+    def connect(self):
+        """
+        Opens a connection and applies the pragmas to it.
+
+        """
+        conn = sqlite3.connect(self.path, check_same_thread=False,
+                               cached_statements=self.cached_statements)
+        for name, value in self.pragmas:
+            conn.execute("pragma {} = {}".format(name, value))
+
+        return conn
+
+    @contextmanager
+    def writer(self):
+        """
+        Context manager giving the caller exclusive use of the writer
+        connection. Its changes are committed when the block ends, or rolled
+        back if it raises.
+
+        """
+        with self.lock:
+            if self.write_conn is None:
+                self.write_conn = self.connect()
+            with self.write_conn:
+                yield self.write_conn
+
+    @contextmanager
+    def reader(self):
+        """
+        Context manager lending the caller a reader connection from the pool.
+        Results must be fetched before the block ends.
+
+        """
+        try:
+            conn = self.readers.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self.readers_lock:
+                if len(self.reader_conns) < self.max_readers:
+                    conn = self.connect()
+                    self.reader_conns.append(conn)
+            if conn is None:
+                conn = self.readers.get()
+        try:
+            yield conn
+        finally:
+            self.readers.put(conn)
+
+    def close(self):
+        """
+        Closes the writer and every reader connection.
+
+        """
+        with self.lock:
+            if self.write_conn is not None:
+                self.write_conn.close()
+                self.write_conn = None
+        with self.readers_lock:
+            for conn in self.reader_conns:
+                conn.close()
+            self.reader_conns = []
+            self.readers = queue.Queue()
@@ -0,0 +1,674 @@
+"""
+directory.py
+
+Backends for the directory server's file directory. Each backend keeps the
+files shared by every connected host and answers substring searches over
+their names:
+
+    SqliteDirectory -- the hosts and files tables of an SQLite database,
+                       searched through an FTS5 trigram index.
+    MemoryDirectory -- dicts keyed by host, an array-backed file table and
+                       an in-memory trigram index. Nothing survives a
+                       restart, which the server doesn't need by default.
+
+CachedDirectory wraps either one with an LRU cache of search results.
+
+Searches match as SQLite's LIKE does: case-insensitively for ASCII letters
+only, with % and _ acting as wildcards.
+"""
+
+import itertools
+import re
+import sqlite3
+import string
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+
+# Search strings shorter than a trigram can't use an index
+MIN_INDEXED_SEARCH = 3
+
+# Folds ASCII letters only, as LIKE does
+ASCII_FOLD = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+class Directory(object):
+    """
+    Interface of the directory backends.
+
+    """
+    def reset(self, keep=False):
+        """
+        Prepares an empty directory, or with keep set, keeps existing entries
+        where the backend can.
+
+        Returns:
+        The number of entries migrated from an older format.
+
+        """
+        raise NotImplementedError
+
+    def add(self, host_id, host_ip_addr, file_list):
+        """
+        Adds files shared by a host, skipping files the host already shares.
+
+        Arguments:
+        host_id, host_ip_addr -- the sharing host.
+        file_list -- iterable of (filename, filesize) tuples.
+
+        Returns:
+        The number of files added.
+
+        """
+        raise NotImplementedError
+
+    def query(self, client_id, search_string, search_host=""):
+        """
+        Finds the files whose names contain search_string, excluding those
+        shared by client_id (unless it is None) and, if search_host is given,
+        those not shared by search_host.
+
+        Returns:
+        A list of (hostid, hostip, filename, filesize) tuples.
+
+        """
+        raise NotImplementedError
+
+    def remove_files(self, host_id, filenames):
+        """
+        Removes files shared by a host.
+
+        Returns:
+        The number of files removed.
+
+        """
+        raise NotImplementedError
+
+    def remove_host(self, host_id):
+        """
+        Removes a host and all the files it shares.
+
+        Returns:
+        The number of files removed.
+
+        """
+        raise NotImplementedError
+
+    def remove_hosts(self, host_ids):
+        """
+        Removes several hosts and all the files they share, at once where
+        the backend can.
+
+        Returns:
+        The number of files removed.
+
+        """
+        return sum(self.remove_host(host_id) for host_id in host_ids)
+
+    def clients(self):
+        """
+        Returns a list of (hostid, hostip) tuples of the hosts sharing files.
+
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SqliteDirectory(Directory):
+    """
+    The directory as hosts and files tables in SQLite, used through a
+    dbpool.ConnectionManager.
+
+    """
+    def __init__(self, db):
+        self.db = db
+        # Rows inserted per executemany call when adding files
+        self.insert_chunk = 10000
+        # Set by reset if SQLite has the FTS5 trigram tokenizer, in which
+        # case searches use the files_fts substring index
+        self.fts_enabled = False
+
+    def reset(self, keep=False):
+        """
+        Creates the schema: a hosts table with one row per client, and a
+        files table whose rows refer to their host. The database is emptied
+        first unless keep is set, in which case existing data is kept and a
+        directory table from older versions of the server is migrated.
+
+        """
+        migrated = 0
+        with self.db.writer() as c:
+            cursor = c.cursor()
+            if not keep:
+                for table in ("files_fts", "files", "hosts", "directory_fts", "directory"):
+                    cursor.execute("drop table if exists {}".format(table))
+            # last_seen is the time the host last changed its shared files
+            cursor.execute("""create table if not exists hosts
+                           (id integer primary key, hostid text not null unique,
+                           hostip text, last_seen real)""")
+            # id keeps rowids stable for the external-content index
+            cursor.execute("""create table if not exists files
+                           (id integer primary key, host integer not null references hosts (id),
+                           filename text, filesize integer)""")
+            # Serves per-host lookups, and lets add skip files a host has
+            # already shared
+            cursor.execute("""create unique index if not exists files_host_filename
+                           on files (host, filename)""")
+            self.fts_enabled = self.init_fts(cursor)
+            if keep:
+                migrated = self.migrate_directory(cursor)
+
+        return migrated
+
+    def init_fts(self, cursor):
+        """
+        Creates files_fts, a trigram index of the filenames in files, and the
+        triggers that keep it in sync with inserts and deletes.
+
+        Returns:
+        False if this SQLite has no FTS5 trigram tokenizer, else True.
+
+        """
+        cursor.execute("select 1 from sqlite_master where name = 'files_fts'")
+        if cursor.fetchone():
+            return True
+        try:
+            cursor.execute("""create virtual table files_fts using fts5
+                           (filename, content='files', content_rowid='id',
+                           tokenize='trigram')""")
+        except sqlite3.OperationalError:
+            return False
+        cursor.execute("""create trigger files_fts_insert after insert on files begin
+                       insert into files_fts(rowid, filename) values (new.id, new.filename);
+                       end""")
+        cursor.execute("""create trigger files_fts_delete after delete on files begin
+                       insert into files_fts(files_fts, rowid, filename)
+                       values ('delete', old.id, old.filename);
+                       end""")
+        cursor.execute("""create trigger files_fts_update after update of filename on files begin
+                       insert into files_fts(files_fts, rowid, filename)
+                       values ('delete', old.id, old.filename);
+                       insert into files_fts(rowid, filename) values (new.id, new.filename);
+                       end""")
+        # Index files kept from before the index existed
+        cursor.execute("insert into files_fts(files_fts) values ('rebuild')")
+
+        return True
+
+    def migrate_directory(self, cursor):
+        """
+        Moves the rows of the single directory table used by older versions
+        of the server into hosts and files, then drops it.
+
+        Returns:
+        The number of files migrated.
+
+        """
+        cursor.execute("select 1 from sqlite_master where type = 'table' and name = 'directory'")
+        if not cursor.fetchone():
+            return 0
+        cursor.execute("""insert or ignore into hosts (hostid, hostip, last_seen)
+                       select hostid, max(hostip), ? from directory group by hostid""",
+                       [time.time()])
+        cursor.execute("""insert or ignore into files (host, filename, filesize)
+                       select hosts.id, directory.filename, directory.filesize
+                       from directory join hosts on hosts.hostid = directory.hostid""")
+        migrated = cursor.rowcount
+        cursor.execute("drop table if exists directory_fts")
+        cursor.execute("drop table directory")
+
+        return migrated
+
+    def add(self, host_id, host_ip_addr, file_list):
+        """
+        Adds the files in a single transaction, insert_chunk rows per
+        executemany call.
+
+        """
+        added = 0
+        with self.db.writer() as c:
+            cur = c.cursor()
+            cur.execute("""insert into hosts (hostid, hostip, last_seen) values (?, ?, ?)
+                        on conflict (hostid) do update
+                        set hostip = excluded.hostip, last_seen = excluded.last_seen""",
+                        [host_id, host_ip_addr, time.time()])
+            cur.execute("select id from hosts where hostid = ?", [host_id])
+            host = cur.fetchone()[0]
+            rows = ((host, filename, filesize) for filename, filesize in file_list)
+            while True:
+                chunk = list(itertools.islice(rows, self.insert_chunk))
+                if not chunk:
+                    break
+                cur.executemany("insert or ignore into files (host, filename, filesize) "
+                                "values (?, ?, ?)", chunk)
+                added += cur.rowcount
+
+        return added
+
+    def query(self, client_id, search_string, search_host=""):
+        """
+        Candidates come from the trigram index when it is available and the
+        search string is long enough, and are then checked with LIKE itself.
+
+        """
+        pattern = '%' + search_string + '%'
+        query = ("select hosts.hostid, hosts.hostip, files.filename, files.filesize "
+                 "from files join hosts on hosts.id = files.host where files.filename like ?")
+        params = [pattern]
+        if self.fts_enabled and len(search_string) >= MIN_INDEXED_SEARCH:
+            query += " and files.id in (select rowid from files_fts where filename like ?)"
+            params.append(pattern)
+        if search_host:
+            query += " and hosts.hostid = ?"
+            params.append(search_host)
+        if client_id is not None:
+            query += " and hosts.hostid != ?"
+            params.append(client_id)
+        with self.db.reader() as c:
+            cur = c.cursor()
+            cur.execute(query, params)
+            rows = cur.fetchall()
+
+        return rows
+
+    def remove_files(self, host_id, filenames):
+        with self.db.writer() as c:
+            cur = c.cursor()
+            cur.execute("select id from hosts where hostid = ?", [host_id])
+            host = cur.fetchone()
+            if host is None:
+                return 0
+            cur.executemany("delete from files where host = ? and filename = ?",
+                            [(host[0], filename) for filename in filenames])
+            changes = cur.rowcount
+            cur.execute("update hosts set last_seen = ? where id = ?", [time.time(), host[0]])
+
+        return changes
+
+    def remove_host(self, host_id):
+        with self.db.writer() as c:
+            cur = c.cursor()
+            cur.execute("select id from hosts where hostid = ?", [host_id])
+            host = cur.fetchone()
+            if host is None:
+                return 0
+            cur.execute("delete from files where host = ?", [host[0]])
+            changes = cur.rowcount
+            cur.execute("delete from hosts where id = ?", [host[0]])
+
+        return changes
+
+    def remove_hosts(self, host_ids):
+        params = [(host_id,) for host_id in host_ids]
+        with self.db.writer() as c:
+            cur = c.cursor()
+            cur.executemany("delete from files where host = (select id from hosts where hostid = ?)",
+                            params)
+            changes = cur.rowcount
+            cur.executemany("delete from hosts where hostid = ?", params)
+
+        return changes
+
+    def clients(self):
+        with self.db.reader() as c:
+            cur = c.cursor()
+            cur.execute("""select hostid, hostip from hosts
+                        where exists (select 1 from files where files.host = hosts.id)""")
+            current_clients = cur.fetchall()
+
+        return current_clients
+
+    def close(self):
+        self.db.close()
+
+
+class MemoryHost(object):
+    """
+    A host in a MemoryDirectory, with its files as filename -> slot.
+
+    """
+    __slots__ = ("index", "hostid", "hostip", "last_seen", "files")
+
+    def __init__(self, index, hostid, hostip):
+        self.index = index
+        self.hostid = hostid
+        self.hostip = hostip
+        self.last_seen = time.time()
+        self.files = {}
+
+
+class MemoryDirectory(Directory):
+    """
+    The directory in memory. Files live in slots of a table of parallel
+    arrays (names, sizes and owning host), and freed slots are reused. The
+    substring index maps each trigram of the ASCII-folded filenames to an
+    array of slots; entries of removed files are left in place and filtered
+    out by the final match, until they outnumber the live ones and the index
+    is rebuilt.
+
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, keep=False):
+        with self.lock:
+            self.hosts = {}
+            self.host_list = []
+            self.free_hosts = []
+            self.names = []
+            # Sizes that aren't integers are stored as -1
+            self.sizes = array('q')
+            self.owners = array('i')
+            self.free_slots = []
+            self.index = {}
+            self.postings = 0
+            self.stale = 0
+
+        return 0
+
+    @staticmethod
+    def trigrams(name):
+        return {name[i:i + 3] for i in range(len(name) - 2)}
+
+    def index_slot(self, slot, name):
+        for trigram in self.trigrams(name.translate(ASCII_FOLD)):
+            postings = self.index.get(trigram)
+            if postings is None:
+                postings = self.index[trigram] = array('i')
+            postings.append(slot)
+            self.postings += 1
+
+    def free_slot(self, slot):
+        name = self.names[slot]
+        self.stale += len(self.trigrams(name.translate(ASCII_FOLD)))
+        self.names[slot] = None
+        self.owners[slot] = -1
+        self.free_slots.append(slot)
+
+    def rebuild_index(self):
+        """
+        Rebuilds the trigram index without the entries of removed files.
+
+        """
+        self.index = {}
+        self.postings = 0
+        self.stale = 0
+        for slot, name in enumerate(self.names):
+            if name is not None:
+                self.index_slot(slot, name)
+
+    def add(self, host_id, host_ip_addr, file_list):
+        added = 0
+        with self.lock:
+            host = self.hosts.get(host_id)
+            if host is None:
+                if self.free_hosts:
+                    index = self.free_hosts.pop()
+                else:
+                    index = len(self.host_list)
+                    self.host_list.append(None)
+                host = self.hosts[host_id] = self.host_list[index] = MemoryHost(index, host_id,
+                                                                                host_ip_addr)
+            host.hostip = host_ip_addr
+            host.last_seen = time.time()
+            for filename, filesize in file_list:
+                if filename in host.files:
+                    continue
+                try:
+                    filesize = int(filesize)
+                except ValueError:
+                    filesize = -1
+                if self.free_slots:
+                    slot = self.free_slots.pop()
+                    self.names[slot] = filename
+                    self.sizes[slot] = filesize
+                    self.owners[slot] = host.index
+                else:
+                    slot = len(self.names)
+                    self.names.append(filename)
+                    self.sizes.append(filesize)
+                    self.owners.append(host.index)
+                host.files[filename] = slot
+                self.index_slot(slot, filename)
+                added += 1
+
+        return added
+
+    def matcher(self, search_string):
+        """
+        Returns a function telling whether an ASCII-folded filename contains
+        search_string, with LIKE's wildcards, and the literal substring the
+        index can look up.
+
+        """
+        folded = search_string.translate(ASCII_FOLD)
+        if "%" not in folded and "_" not in folded:
+            return (lambda name: folded in name), folded
+        pattern = re.compile("".join(".*" if c == "%" else "." if c == "_" else re.escape(c)
+                                     for c in folded), re.DOTALL)
+        literal = max(re.split("[%_]", folded), key=len)
+
+        return (lambda name: pattern.search(name) is not None), literal
+
+    def query(self, client_id, search_string, search_host=""):
+        match, literal = self.matcher(search_string)
+        with self.lock:
+            if search_host:
+                host = self.hosts.get(search_host)
+                candidates = sorted(host.files.values()) if host is not None else []
+            elif len(literal) >= MIN_INDEXED_SEARCH:
+                lists = [self.index.get(trigram) for trigram in self.trigrams(literal)]
+                if not all(lists):
+                    return []
+                candidates = sorted(set(min(lists, key=len)))
+            else:
+                candidates = range(len(self.names))
+            rows = []
+            for slot in candidates:
+                name = self.names[slot]
+                if name is None or not match(name.translate(ASCII_FOLD)):
+                    continue
+                host = self.host_list[self.owners[slot]]
+                if host.hostid == client_id:
+                    continue
+                rows.append((host.hostid, host.hostip, name, self.sizes[slot]))
+
+        return rows
+
+    def remove_files(self, host_id, filenames):
+        removed = 0
+        with self.lock:
+            host = self.hosts.get(host_id)
+            if host is None:
+                return 0
+            for filename in filenames:
+                slot = host.files.pop(filename, None)
+                if slot is not None:
+                    self.free_slot(slot)
+                    removed += 1
+            host.last_seen = time.time()
+            self.maybe_rebuild()
+
+        return removed
+
+    def remove_host(self, host_id):
+        return self.remove_hosts([host_id])
+
+    def remove_hosts(self, host_ids):
+        removed = 0
+        with self.lock:
+            for host_id in host_ids:
+                host = self.hosts.pop(host_id, None)
+                if host is None:
+                    continue
+                for slot in host.files.values():
+                    self.free_slot(slot)
+                self.host_list[host.index] = None
+                self.free_hosts.append(host.index)
+                removed += len(host.files)
+            self.maybe_rebuild()
+
+        return removed
+
+    def maybe_rebuild(self):
+        if self.stale > self.postings // 2:
+            self.rebuild_index()
+
+    def clients(self):
+        with self.lock:
+            return [(host.hostid, host.hostip) for host in self.hosts.values() if host.files]
+
+    def memory_usage(self):
+        """
+        Returns an estimate, in bytes, of the memory used by the directory's
+        tables and index.
+
+        """
+        with self.lock:
+            total = sys.getsizeof(self.names) + self.sizes.buffer_info()[1] * 8
+            total += self.owners.buffer_info()[1] * self.owners.itemsize
+            total += sum(sys.getsizeof(name) for name in self.names if name is not None)
+            total += sys.getsizeof(self.index)
+            for trigram, postings in self.index.items():
+                total += sys.getsizeof(trigram) + sys.getsizeof(postings)
+            for host in self.hosts.values():
+                total += sys.getsizeof(host) + sys.getsizeof(host.files)
+
+        return total
+
+
+class CachedDirectory(Directory):
+    """
+    Wraps a directory backend with an LRU cache of search results keyed by
+    (search_string, search_host). Results are cached for every client and
+    the requesting client's own files are filtered out after the lookup.
+
+    Every change to the directory bumps a generation counter, and cached
+    results from an earlier generation are treated as misses. A search that
+    raced with a change is thus stored under the generation it started in,
+    and never served.
+
+    """
+    def __init__(self, backend, max_entries=1024, max_rows=100000):
+        """
+        Arguments:
+        backend -- the Directory to cache.
+        max_entries -- largest number of cached searches.
+        max_rows -- largest total number of cached result rows. Larger
+                    results are not cached.
+
+        """
+        self.backend = backend
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.lock = threading.Lock()
+        # (search_string, search_host) -> (generation, rows)
+        self.cache = OrderedDict()
+        self.cached_rows = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+
+    def reset(self, keep=False):
+        try:
+            return self.backend.reset(keep)
+        finally:
+            # After the backend reset, so that rows read before it are not
+            # cached under the new generation
+            with self.lock:
+                self.generation += 1
+                self.cache.clear()
+                self.cached_rows = 0
+
+    def add(self, host_id, host_ip_addr, file_list):
+        try:
+            return self.backend.add(host_id, host_ip_addr, file_list)
+        finally:
+            # Even with no files added, the host's IP address may have changed
+            self.invalidate()
+
+    def query(self, client_id, search_string, search_host=""):
+        key = (search_string, search_host)
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None and entry[0] == self.generation:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                rows = entry[1]
+            else:
+                self.misses += 1
+                generation = self.generation
+                rows = None
+        if rows is None:
+            rows = self.backend.query(None, search_string, search_host)
+            self.store(key, generation, rows)
+
+        return [row for row in rows if row[0] != client_id]
+
+    def store(self, key, generation, rows):
+        """
+        Caches the rows found by a search that started in generation.
+
+        """
+        if len(rows) > self.max_rows:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            old = self.cache.pop(key, None)
+            if old is not None:
+                self.cached_rows -= len(old[1])
+            self.cache[key] = (generation, rows)
+            self.cached_rows += len(rows)
+            while len(self.cache) > self.max_entries or self.cached_rows > self.max_rows:
+                evicted = self.cache.popitem(last=False)[1]
+                self.cached_rows -= len(evicted[1])
+
+    def remove_files(self, host_id, filenames):
+        removed = self.backend.remove_files(host_id, filenames)
+        if removed:
+            self.invalidate()
+
+        return removed
+
+    def remove_host(self, host_id):
+        removed = self.backend.remove_host(host_id)
+        if removed:
+            self.invalidate()
+
+        return removed
+
+    def remove_hosts(self, host_ids):
+        removed = self.backend.remove_hosts(host_ids)
+        if removed:
+            self.invalidate()
+
+        return removed
+
+    def clients(self):
+        return self.backend.clients()
+
+    def stats(self):
+        """
+        Returns the cache's counters as a dict.
+
+        """
+        with self.lock:
+            return {"entries": len(self.cache),
+                    "rows": self.cached_rows,
+                    "generation": self.generation,
+                    "hits": self.hits,
+                    "misses": self.misses}
+
+    def close(self):
+        self.backend.close()
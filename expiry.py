@@ -0,0 +1,146 @@
+"""
+expiry.py
+
+Expires keys that have not been touched for a given time. The directory
+server uses an ExpiryScheduler to forget hosts that have gone quiet: each
+message from a host touches it, and a background thread hands the hosts that
+have timed out to a callback, in batches.
+"""
+
+import heapq
+import threading
+import time
+
+
+class ExpiryScheduler(object):
+    """
+    Keeps the time each key was last touched, and a heap of (deadline, key)
+    entries ordered by when they expire. Touching a key pushes a new entry
+    rather than moving the old one, which is skipped when it reaches the top
+    of the heap, so a touch costs O(log n).
+
+    """
+    def __init__(self, timeout, callback, lock=None):
+        """
+        Arguments:
+        timeout -- seconds after its last touch at which a key expires.
+        callback -- called from the expiry thread with a list of expired
+                    keys, without the lock held.
+        lock -- the lock guarding the scheduler's state. A new lock is
+                created if None.
+
+        """
+        self.timeout = timeout
+        self.callback = callback
+        self.lock = lock if lock is not None else threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        # key -> time.monotonic() of the last touch. Deadlines in the heap
+        # are on the same clock, so steps of the wall clock don't move them.
+        self.last_seen = {}
+        self.heap = []
+        self.expired = 0
+        self.thread = None
+        self.stopped = False
+
+    def touch(self, key, now=None):
+        """
+        Records activity from key, postponing its expiry.
+
+        Arguments:
+        key -- the key touched.
+        now -- the time of the activity, as returned by time.monotonic().
+               Defaults to the current time.
+
+        """
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            first = not self.heap or now + self.timeout < self.heap[0][0]
+            self.last_seen[key] = now
+            heapq.heappush(self.heap, (now + self.timeout, key))
+            if len(self.heap) > 2 * len(self.last_seen) + 64:
+                self.compact()
+            if first:
+                self.wakeup.notify()
+
+    def discard(self, key):
+        """
+        Forgets key without expiring it.
+
+        """
+        with self.lock:
+            self.last_seen.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.last_seen.clear()
+            self.heap = []
+
+    def compact(self):
+        """
+        Rebuilds the heap with one entry per key. Called with the lock held.
+
+        """
+        self.heap = [(last + self.timeout, key) for key, last in self.last_seen.items()]
+        heapq.heapify(self.heap)
+
+    def pop_expired(self, now):
+        """
+        Removes the keys whose deadline has passed by now, a time.monotonic()
+        value. Called with the lock held.
+
+        Returns:
+        A list of the expired keys.
+
+        """
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, key = heapq.heappop(self.heap)
+            last = self.last_seen.get(key)
+            # Skip entries superseded by a later touch, or of discarded keys
+            if last is not None and last + self.timeout <= now:
+                del self.last_seen[key]
+                expired.append(key)
+
+        return expired
+
+    def __len__(self):
+        with self.lock:
+            return len(self.last_seen)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.last_seen
+
+    def start(self):
+        self.thread = threading.Thread(target=self.expiry_thread, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.wakeup.notify()
+
+    def expiry_thread(self):
+        """
+        Sleeps until the earliest deadline, then passes every key that has
+        expired by then to the callback.
+
+        """
+        while True:
+            with self.lock:
+                while not self.stopped:
+                    now = time.monotonic()
+                    expired = self.pop_expired(now)
+                    if expired:
+                        break
+                    self.wakeup.wait(self.heap[0][0] - now if self.heap else None)
+                if self.stopped:
+                    return
+                self.expired += len(expired)
+            try:
+                self.callback(expired)
+            except Exception:
+                # Keep expiring; the keys are tried again only if touched
+                pass
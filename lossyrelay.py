@@ -0,0 +1,209 @@
+"""
+lossyrelay.py
+
+A UDP relay for testing RDT over an impaired path on one host. Senders send to
+the relay, which forwards each datagram to the target - and the target's
+replies back to the sender - dropping, duplicating, delaying and reordering
+them at the configured rates.
+
+Usage:
+python lossyrelay.py TARGET_PORT [--port PORT] [--loss 0.01] [--delay 0.02] ...
+"""
+
+import argparse
+import heapq
+import random
+import select
+import socket
+import threading
+import time
+
+
+class LossyRelay(object):
+    """
+    Relays datagrams between clients and a target address. Each client gets
+    its own upstream socket, so the target's replies - which may come from a
+    different socket than the one the client sent to - are relayed back to
+    the client that caused them. Impairments apply in both directions.
+
+    """
+    def __init__(self, target, port=0, loss=0.0, duplicate=0.0, reorder=0.0,
+                 delay=0.0, jitter=0.0, reorder_delay=0.005, seed=None):
+        """
+        Arguments:
+        target -- the (host, port) address datagrams are relayed to.
+        port -- the local port clients send to; 0 picks an ephemeral port.
+        loss -- probability that a datagram is dropped.
+        duplicate -- probability that a datagram is sent twice.
+        reorder -- probability that a datagram is held back by an extra
+                   reorder_delay seconds, letting later ones overtake it.
+        delay -- one-way delay in seconds added to every datagram.
+        jitter -- maximum random delay in seconds added on top of delay.
+        seed -- seed for the impairments, for reproducible runs.
+
+        """
+        self.target = target
+        self.loss = loss
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder_delay = reorder_delay
+        self.random = random.Random(seed)
+        self.listen_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listen_sock.bind(('127.0.0.1', port))
+        self.port = self.listen_sock.getsockname()[1]
+        # client address -> upstream socket, and the reverse
+        self.upstream = {}
+        self.clients = {}
+        # Heap of (due time, order, socket, data, address) of delayed datagrams
+        self.scheduled = []
+        self.scheduled_order = 0
+        self.schedule_cond = threading.Condition()
+        self.running = False
+        self.forwarded = 0
+        self.dropped = 0
+        self.duplicated = 0
+        self.reordered = 0
+
+    def start(self):
+        """
+        Starts relaying in background threads.
+
+        """
+        self.running = True
+        for target in (self.relay_thread, self.delivery_thread):
+            thread = threading.Thread(target=target, args=())
+            thread.daemon = True
+            thread.start()
+
+    def relay_thread(self):
+        """
+        Waits for datagrams from clients and from the target, and relays them.
+
+        """
+        while self.running:
+            socks = [self.listen_sock] + list(self.clients)
+            try:
+                readable = select.select(socks, [], [], 0.1)[0]
+            except (OSError, ValueError):
+                # A socket was closed
+                break
+            for sock in readable:
+                try:
+                    data, address = sock.recvfrom(65535)
+                except OSError:
+                    continue
+                if sock is self.listen_sock:
+                    upstream = self.upstream.get(address)
+                    if upstream is None:
+                        upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                        upstream.bind(('127.0.0.1', 0))
+                        self.upstream[address] = upstream
+                        self.clients[upstream] = address
+                    self.impair(upstream, data, self.target)
+                else:
+                    self.impair(self.listen_sock, data, self.clients[sock])
+
+    def impair(self, sock, data, address):
+        """
+        Drops, duplicates, delays or reorders a datagram, and sends what is
+        left of it through sock.
+
+        """
+        if self.random.random() < self.loss:
+            self.dropped += 1
+            return
+
+        copies = 1
+        if self.random.random() < self.duplicate:
+            self.duplicated += 1
+            copies = 2
+        for i in range(copies):
+            delay = self.delay + self.random.random() * self.jitter
+            if self.random.random() < self.reorder:
+                self.reordered += 1
+                delay += self.reorder_delay
+            if delay > 0:
+                self.schedule(time.perf_counter() + delay, sock, data, address)
+            else:
+                self.send(sock, data, address)
+
+    def schedule(self, due, sock, data, address):
+        with self.schedule_cond:
+            self.scheduled_order += 1
+            heapq.heappush(self.scheduled, (due, self.scheduled_order, sock, data, address))
+            self.schedule_cond.notify()
+
+    def delivery_thread(self):
+        """
+        Sends delayed datagrams once they are due.
+
+        """
+        with self.schedule_cond:
+            while self.running:
+                if not self.scheduled:
+                    self.schedule_cond.wait(0.1)
+                    continue
+                wait = self.scheduled[0][0] - time.perf_counter()
+                if wait > 0:
+                    self.schedule_cond.wait(wait)
+                    continue
+                due, order, sock, data, address = heapq.heappop(self.scheduled)
+                self.send(sock, data, address)
+
+    def send(self, sock, data, address):
+        try:
+            sock.sendto(data, address)
+            self.forwarded += 1
+        except OSError:
+            # Closed socket or full buffer; the datagram is lost
+            self.dropped += 1
+
+    def stats(self):
+        """
+        Returns the relay's counters as a dict.
+
+        """
+        return {"forwarded": self.forwarded,
+                "dropped": self.dropped,
+                "duplicated": self.duplicated,
+                "reordered": self.reordered}
+
+    def close(self):
+        """
+        Stops relaying and closes the relay's sockets.
+
+        """
+        self.running = False
+        with self.schedule_cond:
+            self.schedule_cond.notify()
+        self.listen_sock.close()
+        for upstream in self.clients:
+            upstream.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Impairing UDP relay")
+    parser.add_argument("target_port", type=int)
+    parser.add_argument("--target-host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--loss", type=float, default=0.0)
+    parser.add_argument("--duplicate", type=float, default=0.0)
+    parser.add_argument("--reorder", type=float, default=0.0)
+    parser.add_argument("--delay", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    relay = LossyRelay((args.target_host, args.target_port), args.port, args.loss,
+                       args.duplicate, args.reorder, args.delay, args.jitter,
+                       seed=args.seed)
+    relay.start()
+    print("Relaying port {} to {}:{}".format(relay.port, args.target_host, args.target_port))
+    try:
+        while True:
+            time.sleep(10)
+            print(relay.stats())
+    except KeyboardInterrupt:
+        relay.close()
@@ -0,0 +1,278 @@
+"""
+metrics.py
+
+Counters, gauges and histograms for the RDT layer and the directory server,
+kept in a Registry. The module-level registry is shared by everything in the
+process; its contents can be printed (the server's stats command) or served
+over HTTP on localhost by a MetricsServer, as Prometheus text at /metrics
+and as JSON at /metrics.json.
+"""
+
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Upper bounds, in seconds, of the default histogram buckets: 10us to ~84s,
+# doubling each time
+DEFAULT_BUCKETS = [1e-5 * 2 ** i for i in range(24)]
+
+
+def metric_key(name, labels):
+    """
+    Returns the name under which a metric with the given labels is kept, in
+    Prometheus form (e.g. 'requests{method="QUERY"}').
+
+    """
+    if not labels:
+        return name
+
+    return "{}{{{}}}".format(name, ",".join('{}="{}"'.format(label, value)
+                                            for label, value in sorted(labels.items())))
+
+
+class Counter(object):
+    """
+    A value that only goes up.
+
+    """
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+
+class Histogram(object):
+    """
+    Counts observations in buckets of fixed upper bounds, plus their sum and
+    maximum. Percentiles are estimated as the upper bound of the bucket they
+    fall in, or the maximum if that is smaller.
+
+    """
+    def __init__(self, buckets=None):
+        self.bounds = buckets if buckets is not None else DEFAULT_BUCKETS
+        # The last bucket holds observations above every bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def time(self):
+        """
+        Returns a context manager observing the seconds its block takes.
+
+        """
+        return Timer(self)
+
+    def percentile(self, fraction):
+        """
+        Returns the estimated percentile, or None with no observations.
+
+        """
+        with self.lock:
+            if not self.count:
+                return None
+            rank = fraction * self.count
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank:
+                    break
+
+            largest = self.max
+
+        return min(self.bounds[index], largest) if index < len(self.bounds) else largest
+
+    def summary(self):
+        with self.lock:
+            count, total, largest = self.count, self.sum, self.max
+
+        return {"count": count,
+                "mean": total / count if count else None,
+                "p50": self.percentile(0.50),
+                "p99": self.percentile(0.99),
+                "max": largest if count else None}
+
+
+class Timer(object):
+    """
+    Context manager observing the duration of its block in a Histogram.
+
+    """
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Registry(object):
+    """
+    The metrics of a process, by name. Asking for a metric that already
+    exists returns it, so several objects can share one.
+
+    """
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        # name -> function returning the current value
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def counter(self, name, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            if key not in self.counters:
+                self.counters[key] = Counter()
+
+            return self.counters[key]
+
+    def histogram(self, name, buckets=None, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+
+            return self.histograms[key]
+
+    def gauge(self, name, function, **labels):
+        """
+        Registers function, called without arguments whenever the metrics
+        are read, as the source of a gauge's value. Replaces any earlier
+        function for the same gauge.
+
+        """
+        with self.lock:
+            self.gauges[metric_key(name, labels)] = function
+
+    def gauge_values(self):
+        """
+        Returns the current value of every gauge, or None for those whose
+        function raised.
+
+        """
+        with self.lock:
+            gauges = list(self.gauges.items())
+        values = {}
+        for name, function in gauges:
+            try:
+                values[name] = function()
+            except Exception:
+                values[name] = None
+
+        return values
+
+    def snapshot(self):
+        """
+        Returns the current value of every metric as a dict.
+
+        """
+        with self.lock:
+            counters = list(self.counters.items())
+            histograms = list(self.histograms.items())
+
+        return {"counters": {name: counter.value for name, counter in counters},
+                "gauges": self.gauge_values(),
+                "histograms": {name: histogram.summary() for name, histogram in histograms}}
+
+    def text(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+
+        """
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        lines = ["{} {}".format(name, counter.value) for name, counter in counters]
+        for name, value in sorted(self.gauge_values().items()):
+            if value is not None:
+                lines.append("{} {}".format(name, value))
+        for name, histogram in histograms:
+            base, brace, labels = name.partition("{")
+            labels = labels[:-1]
+            with histogram.lock:
+                counts = list(histogram.counts)
+                count, total = histogram.count, histogram.sum
+            seen = 0
+            for bound, bucket in zip(histogram.bounds + ["+Inf"], counts):
+                seen += bucket
+                le = 'le="{}"'.format(bound if bound == "+Inf" else "{:.6g}".format(bound))
+                lines.append("{}_bucket{{{}}} {}".format(base, ",".join(filter(None, [labels, le])),
+                                                         seen))
+            suffix = "{" + labels + "}" if labels else ""
+            lines.append("{}_sum{} {}".format(base, suffix, total))
+            lines.append("{}_count{} {}".format(base, suffix, count))
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = self.server.registry.text().encode()
+            content_type = "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body = json.dumps(self.server.registry.snapshot(), indent=2).encode()
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth a line of output each
+        pass
+
+
+class MetricsServer(object):
+    """
+    Serves a Registry over HTTP from a background thread.
+
+    """
+    def __init__(self, port, host="127.0.0.1", metrics_registry=None):
+        """
+        Arguments:
+        port -- TCP port to listen on; 0 picks a free one.
+        host -- address to listen on. Defaults to localhost only.
+        metrics_registry -- the Registry to serve; defaults to registry.
+
+        """
+        self.httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.registry = metrics_registry if metrics_registry is not None else registry
+        self.port = self.httpd.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.httpd.serve_forever, args=())
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,238 @@
+"""
+mmsg.py
+
+Batched datagram I/O for the RDT layer. On Linux, BatchReceiver and send_batch
+move many datagrams per system call with recvmmsg(2) and sendmmsg(2), called
+through ctypes. Elsewhere they fall back to draining the socket with
+non-blocking receives, and to one sendto per datagram.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+import struct
+import sys
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(iovec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+# recvmmsg flag: block for the first datagram only
+MSG_WAITFORONE = 0x10000
+# Size of struct sockaddr_storage
+SOCKADDR_SIZE = 128
+# struct sockaddr_in: family (native order), port, address, padding
+SOCKADDR_IN = struct.Struct("=H2s4s8x")
+# Non-blocking flag for the fallback drain, where the platform has one
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+
+
+def load_libc():
+    """
+    Returns libc with recvmmsg and sendmmsg set up for ctypes, or None if they
+    are not available.
+
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        for name in ("recvmmsg", "sendmmsg"):
+            function = getattr(libc, name)
+            function.restype = ctypes.c_int
+        # The mmsghdr arrays are passed by address
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint,
+                                  ctypes.c_int, ctypes.c_void_p]
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    except (OSError, AttributeError):
+        return None
+
+    return libc
+
+
+libc = load_libc()
+
+
+def parse_address(name):
+    """
+    Returns the address tuple, as socket.recvfrom would, of a struct sockaddr.
+
+    """
+    family = struct.unpack_from("=H", name)[0]
+    if family == socket.AF_INET:
+        port, host = struct.unpack_from("!H4s", name, 2)
+        return (socket.inet_ntop(socket.AF_INET, host), port)
+    if family == socket.AF_INET6:
+        port, flowinfo, host, scope_id = struct.unpack_from("!HI16sI", name, 2)
+        return (socket.inet_ntop(socket.AF_INET6, host), port, flowinfo, scope_id)
+
+    return None
+
+
+def set_buffer_sizes(sock, rcvbuf=None, sndbuf=None):
+    """
+    Sets a socket's kernel receive and send buffer sizes, in bytes. None
+    leaves the system default; Linux caps the sizes at net.core.rmem_max and
+    net.core.wmem_max.
+
+    """
+    if rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    if sndbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+
+
+class BatchReceiver(object):
+    """
+    Receives datagrams from a socket in batches. The buffers for a whole batch
+    are allocated once, so a BatchReceiver must only be used by one thread.
+
+    """
+    def __init__(self, sock, count=64, size=65535):
+        """
+        Arguments:
+        sock -- a blocking datagram socket.
+        count -- largest number of datagrams returned per call.
+        size -- largest datagram size; longer datagrams are truncated.
+
+        """
+        self.sock = sock
+        self.count = count
+        self.size = size
+        if libc is None:
+            return
+        self.buffers = ctypes.create_string_buffer(count * size)
+        self.names = ctypes.create_string_buffer(count * SOCKADDR_SIZE)
+        self.iovecs = (iovec * count)()
+        self.msgs = (mmsghdr * count)()
+        base = ctypes.addressof(self.buffers)
+        names = ctypes.addressof(self.names)
+        for i in range(count):
+            self.iovecs[i].iov_base = base + i * size
+            self.iovecs[i].iov_len = size
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_name = names + i * SOCKADDR_SIZE
+            hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            hdr.msg_iovlen = 1
+
+    def recv(self):
+        """
+        Waits for a datagram, then also takes every other datagram already
+        queued on the socket, up to count.
+
+        Returns:
+        A list of (data, address) tuples. An empty datagram ends the list,
+        as it does when the socket is shut down.
+
+        """
+        if libc is None:
+            return self.recv_drain()
+
+        for i in range(self.count):
+            self.msgs[i].msg_hdr.msg_namelen = SOCKADDR_SIZE
+        while True:
+            received = libc.recvmmsg(self.sock.fileno(), ctypes.addressof(self.msgs), self.count,
+                                     MSG_WAITFORONE, None)
+            if received >= 0:
+                break
+            err = ctypes.get_errno()
+            if err != errno.EINTR:
+                raise OSError(err, os.strerror(err))
+
+        batch = []
+        for i in range(received):
+            length = self.msgs[i].msg_len
+            data = self.buffers[i * self.size:i * self.size + length]
+            offset = i * SOCKADDR_SIZE
+            address = parse_address(self.names[offset:offset + SOCKADDR_SIZE])
+            batch.append((data, address))
+            if not data:
+                break
+
+        return batch
+
+    def recv_drain(self):
+        """
+        Fallback for recv: one blocking receive, then non-blocking receives
+        until the socket has nothing more queued.
+
+        """
+        batch = [self.sock.recvfrom(self.size)]
+        if not MSG_DONTWAIT:
+            return batch
+        while len(batch) < self.count and batch[-1][0]:
+            try:
+                batch.append(self.sock.recvfrom(self.size, MSG_DONTWAIT))
+            except (BlockingIOError, InterruptedError):
+                break
+
+        return batch
+
+
+def send_batch(sock, datagrams):
+    """
+    Sends a list of (data, address) tuples, where data is bytes, from an IPv4
+    datagram socket, with one sendmmsg call where possible.
+
+    """
+    if libc is None or len(datagrams) < 2 or sock.family != socket.AF_INET:
+        for data, address in datagrams:
+            sock.sendto(data, address)
+        return
+
+    try:
+        hosts = [socket.inet_aton(address[0]) for data, address in datagrams]
+    except OSError:
+        # A hostname rather than an IP address; leave resolving it to sendto
+        for data, address in datagrams:
+            sock.sendto(data, address)
+        return
+
+    count = len(datagrams)
+    msgs = (mmsghdr * count)()
+    iovecs = (iovec * count)()
+    names = ctypes.create_string_buffer(count * SOCKADDR_IN.size)
+    names_base = ctypes.addressof(names)
+    buffers = []
+    for i, (data, address) in enumerate(datagrams):
+        SOCKADDR_IN.pack_into(names, i * SOCKADDR_IN.size, socket.AF_INET,
+                              struct.pack("!H", address[1]), hosts[i])
+        buffer = ctypes.c_char_p(data)
+        buffers.append(buffer)
+        iovecs[i].iov_base = ctypes.cast(buffer, ctypes.c_void_p)
+        iovecs[i].iov_len = len(data)
+        hdr = msgs[i].msg_hdr
+        hdr.msg_name = names_base + i * SOCKADDR_IN.size
+        hdr.msg_namelen = SOCKADDR_IN.size
+        hdr.msg_iov = ctypes.pointer(iovecs[i])
+        hdr.msg_iovlen = 1
+
+    start = 0
+    while start < count:
+        sent = libc.sendmmsg(sock.fileno(), ctypes.addressof(msgs) + start * ctypes.sizeof(mmsghdr),
+                             count - start, 0)
+        if sent <= 0:
+            # Let sendto raise the error, or send what is left
+            for data, address in datagrams[start:]:
+                sock.sendto(data, address)
+            return
+        start += sent
@@ -8,50 +8,1239 @@ Data Modified: 1 December 2012
 
 import threading
 import socket
+import errno
 import time
 import queue
-from math import ceil
+import struct
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
 
+import metrics
+import mmsg
 
-class Rdt(object):
-    seq_number = 1  # Static sequence number variable shared amongst all
-                    # instances of the Rdt class. Valid values are [1,
-                    # 2147483647] (i.e., a 32-bit signed integer).
 
-    def __init__(self, hostname):
+# Binary wire format. Every binary packet starts with BINARY_MAGIC, a byte
+# that never starts a text packet (those start with the printable hostname),
+# so a receiver can tell the two formats apart from the first byte.
+BINARY_MAGIC = 0xB2
+# magic, flags, host id hash, comm_id, seq, payload length, payload CRC-32
+BINARY_HEADER = struct.Struct("!BBIIIHI")
+FLAG_SYN = 0x01
+FLAG_FIN = 0x02
+FLAG_ACK = 0x04
+# Cumulative ACK: acknowledges every packet of the message up to its seq,
+# plus those marked in the SACK bitmap carried (as 8 hex digits) in its
+# payload, where bit i stands for seq + 1 + i. Only sent in binary format.
+FLAG_CUMULATIVE = 0x08
+# Set on the data packets of messages sent with more than one packet in
+# flight. Only those may have their ACKs delayed; a stop-and-wait sender
+# would wait out the delay on every packet. Older receivers ignore the bit.
+FLAG_WINDOW = 0x10
+# Text form of every combination of the flag bits
+FLAG_NAMES = [("SYN" if bits & FLAG_SYN else "") +
+              ("FIN" if bits & FLAG_FIN else "") +
+              ("ACK" if bits & FLAG_ACK else "") +
+              ("CUM" if bits & FLAG_CUMULATIVE else "") +
+              ("WIN" if bits & FLAG_WINDOW else "") for bits in range(32)]
+# Number of packets past the cumulative seq covered by the SACK bitmap
+SACK_BITS = 32
+
+# Packets are paced at PACING_GAIN congestion windows per estimated RTT,
+# with bursts of at most PACING_BURST packets
+PACING_GAIN = 2.0
+PACING_BURST = 4
+# Appended to the flags of text ACKs by receivers that understand the binary
+# format. Older senders only look for "ACK" in the flags, so they ignore it.
+BINARY_CAPABLE = "BIN"
+# Flag of path MTU probe packets. Receivers ACK them and discard the payload.
+PROBE = "PRB"
+
+# Largest UDP payload over IPv4; receive buffers are sized to hold it
+MAX_DATAGRAM = 65507
+# Receivers that predate configurable packet sizes read at most 1024 bytes
+# per datagram, so peers that have not advertised BINARY_CAPABLE are never
+# sent more than LEGACY_MTU bytes of payload per packet.
+LEGACY_MTU = 128
+
+# PeerState attributes kept when a peer's SenderState is closed: its payload
+# size, whether it speaks the binary format, and its RTT estimates. The
+# congestion window starts over, as after any long idle period.
+PEER_SETTINGS = ("mtu", "binary", "estimated_RTT", "dev_RTT", "timeout_interval",
+                 "rtt_samples")
+
+# Process-wide metrics, shared by every RDT instance
+PACKETS_IN = metrics.registry.counter("rdt_packets_in")
+PACKETS_OUT = metrics.registry.counter("rdt_packets_out")
+RETRANSMITS = metrics.registry.counter("rdt_retransmits")
+TIMEOUTS = metrics.registry.counter("rdt_timeouts")
+MESSAGES_IN = metrics.registry.counter("rdt_messages_in")
+# FIN packets dropped unacknowledged because the message queue was full
+MESSAGES_REFUSED = metrics.registry.counter("rdt_messages_refused")
+RTT_SECONDS = metrics.registry.histogram("rdt_rtt_seconds")
+REASSEMBLY_SECONDS = metrics.registry.histogram("rdt_reassembly_seconds")
+
+
+def seq_add(seq, n):
+    """
+    Returns the sequence number n places after seq, wrapping around after
+    PeerState.MAX_SEQ_NUM.
+
+    """
+    return (seq - 1 + n) % PeerState.MAX_SEQ_NUM + 1
+
+
+def utf8_boundary(data, start, end):
+    """
+    Moves a cut point in UTF-8 encoded data back to the start of the character
+    it falls inside of, so that data[start:end] decodes on its own.
+
+    Arguments:
+    data -- the data as a memoryview of bytes.
+    start, end -- the slice to be cut; end must be less than len(data).
+
+    Returns:
+    The adjusted end, which is end itself if data is not valid UTF-8 there.
+
+    """
+    cut = end
+    while cut > start + 1 and cut > end - 3 and data[cut] & 0xC0 == 0x80:
+        cut -= 1
+    if data[cut] & 0xC0 == 0x80:
+        return end
+
+    return cut
+
+
+def host_hash(hostname):
+    """
+    Returns the 32-bit host id hash carried in binary packet headers.
+
+    """
+    return zlib.crc32(hostname.encode())
+
+
+class ClosedCommunications(object):
+    """
+    The (host_id, comm_id) pairs of recently reassembled messages, used to
+    drop retransmitted duplicates. Lookups and insertions are O(1). Entries
+    expire ttl seconds after they were added, and the oldest entries are
+    evicted once more than max_size are held.
+
+    """
+    def __init__(self, ttl=300.0, max_size=65536):
+        self.ttl = ttl
+        self.max_size = max_size
+        # msgkey -> time added, oldest first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Number of entries dropped by expiry or eviction
+        self.evicted = 0
+
+    def add(self, msgkey):
+        with self.lock:
+            self.entries[msgkey] = time.monotonic()
+            self.entries.move_to_end(msgkey)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evicted += 1
+
+    def __contains__(self, msgkey):
+        added = self.entries.get(msgkey)
+        return added is not None and time.monotonic() - added < self.ttl
+
+    def __len__(self):
+        return len(self.entries)
+
+    def expire(self):
+        """
+        Drops expired entries.
+
+        Returns:
+        The number of entries dropped.
+
+        """
+        cutoff = time.monotonic() - self.ttl
+        count = 0
+        with self.lock:
+            while self.entries:
+                msgkey, added = next(iter(self.entries.items()))
+                if added >= cutoff:
+                    break
+                del self.entries[msgkey]
+                count += 1
+            self.evicted += count
+
+        return count
+
+
+class ReassemblyBuffer(object):
+    """
+    Collects the fragments of one message. Once both the SYN and the FIN have
+    arrived, the number of fragments follows from their sequence numbers and
+    each fragment is stored directly in its slot, so fragments may arrive in
+    any order and no sort is needed. The message is complete when every slot
+    is filled.
+
+    """
+    # Largest number of fragments accepted for a single message
+    MAX_FRAGMENTS = 1 << 20
+
+    def __init__(self):
+        self.syn_seq = None
+        self.fin_seq = None
+        # One slot per fragment, allocated once the fragment count is known
+        self.slots = None
+        self.filled = 0
+        # seq -> payload for fragments that arrive before the SYN or FIN
+        self.early = {}
+        # First seq not yet received contiguously from the SYN
+        self.next_seq = None
+        self.created = self.last_active = time.monotonic()
+
+    def add(self, seq, flags, payload):
+        """
+        Adds a fragment to the message.
+
+        Arguments:
+        seq -- the fragment's sequence number.
+        flags -- the flags field of the fragment's header.
+        payload -- the fragment's payload.
+
+        Returns:
+        True once every fragment of the message has arrived, else False.
+
+        """
+        self.last_active = time.monotonic()
+        if "SYN" in flags:
+            self.syn_seq = seq
+        if "FIN" in flags:
+            self.fin_seq = seq
+
+        if self.slots is not None:
+            self.place(seq, payload)
+        else:
+            self.early[seq] = payload
+            if self.syn_seq is not None and self.fin_seq is not None:
+                count = (self.fin_seq - self.syn_seq) % PeerState.MAX_SEQ_NUM + 1
+                if count > self.MAX_FRAGMENTS:
+                    raise ValueError("Message has too many fragments: {}".format(count))
+                self.slots = [None] * count
+                for early_seq, early_payload in self.early.items():
+                    self.place(early_seq, early_payload)
+                self.early = None
+
+        return self.slots is not None and self.filled == len(self.slots)
+
+    def place(self, seq, payload):
+        index = (seq - self.syn_seq) % PeerState.MAX_SEQ_NUM
+        if index < len(self.slots) and self.slots[index] is None:
+            self.slots[index] = payload
+            self.filled += 1
+
+    def received(self, seq):
+        """
+        Returns True if the fragment with the given seq has arrived. Only valid
+        once the SYN has arrived.
+
+        """
+        if self.slots is None:
+            return seq in self.early
+        index = (seq - self.syn_seq) % PeerState.MAX_SEQ_NUM
+
+        return index < len(self.slots) and self.slots[index] is not None
+
+    def contiguous(self, seq):
+        """
+        Returns True if every fragment from the SYN up to and including seq has
+        arrived.
+
+        """
+        if self.syn_seq is None:
+            return False
+        if self.next_seq is None:
+            self.next_seq = self.syn_seq
+        while self.received(self.next_seq):
+            self.next_seq = seq_add(self.next_seq, 1)
+
+        received = (self.next_seq - self.syn_seq) % PeerState.MAX_SEQ_NUM
+        return (seq - self.syn_seq) % PeerState.MAX_SEQ_NUM < received
+
+    def ack_state(self):
+        """
+        Returns the highest seq received contiguously from the SYN and the
+        SACK bitmap of the fragments received after it. Only valid once the
+        SYN has arrived.
+
+        """
+        self.contiguous(self.syn_seq)
+        cum_seq = seq_add(self.next_seq, -1)
+        sack = 0
+        for i in range(SACK_BITS):
+            if self.received(seq_add(cum_seq, 1 + i)):
+                sack |= 1 << i
+
+        return (cum_seq, sack)
+
+    def message(self):
+        """
+        Returns the reassembled message. Only valid once add returned True.
+
+        """
+        return b''.join(self.slots)
+
+
+class TokenBucket(object):
+    """
+    Token bucket used to pace packets: tokens accumulate at rate per second,
+    up to burst, and each packet sent takes one.
+
+    """
+    def __init__(self, burst, rate=None):
+        self.burst = burst
+        # None means unlimited
+        self.rate = rate
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+
+    def consume(self, n=1):
+        """
+        Takes n tokens from the bucket.
+
+        Returns:
+        The number of seconds to wait before sending, 0 if it may send now.
+
+        """
+        if self.rate is None:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= n
+        if self.tokens >= 0:
+            return 0.0
+
+        return -self.tokens / self.rate
+
+
+class CongestionController(object):
+    """
+    Interface of the per-peer congestion controllers. cwnd is the number of
+    packets the sender may have in flight; the transport reports ACKs and
+    losses, and paces packets at pacing_rate. Controllers are created per
+    peer from the factory in RdtBase.congestion_control, so a delay-based
+    controller only has to implement these methods.
+
+    """
+    # Largest congestion window, in packets
+    MAX_CWND = 1024
+
+    def __init__(self, initial_window=4):
+        self.cwnd = float(initial_window)
+        self.loss_events = 0
+
+    def on_ack(self, acked, rtt):
+        """
+        Called when acked packets have been acknowledged.
+
+        Arguments:
+        acked -- number of packets newly acknowledged.
+        rtt -- current estimated RTT in seconds.
+
+        """
+        pass
+
+    def on_loss(self, now, rtt):
+        """
+        Called when a retransmission timer expires.
+
+        Arguments:
+        now -- the current time.monotonic() value.
+        rtt -- current estimated RTT in seconds.
+
+        """
+        pass
+
+    def pacing_rate(self, rtt):
+        """
+        Returns the rate, in packets per second, at which to pace packets.
+
+        """
+        return PACING_GAIN * self.cwnd / max(rtt, 1e-4)
+
+    def stats(self):
+        return {"cwnd": self.cwnd, "loss_events": self.loss_events}
+
+
+class RenoController(CongestionController):
+    """
+    AIMD congestion control in the style of TCP Reno: slow start up to
+    ssthresh, then an additive increase of one packet per window of ACKs.
+    A loss halves the window, at most once per RTT.
+
+    """
+    def __init__(self, initial_window=4, ssthresh=64):
+        CongestionController.__init__(self, initial_window)
+        self.ssthresh = float(ssthresh)
+        self.recovery_until = 0.0
+
+    def on_ack(self, acked, rtt):
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked
+        else:
+            self.cwnd += acked / self.cwnd
+        self.cwnd = min(self.cwnd, self.MAX_CWND)
+
+    def on_loss(self, now, rtt):
+        if now < self.recovery_until:
+            # Already reduced for a loss in this window
+            return
+        self.ssthresh = max(self.cwnd / 2, 2.0)
+        self.cwnd = self.ssthresh
+        self.recovery_until = now + rtt
+        self.loss_events += 1
+
+    def stats(self):
+        stats = CongestionController.stats(self)
+        stats["ssthresh"] = self.ssthresh
+        return stats
+
+
+class PeerState(object):
+    """
+    Sender-side state for a single peer: the peer's sequence number space, the
+    RTT estimates used to time retransmissions, and what the peer is known to
+    support.
+
+    """
+    # Maximum sequence number value (2^31 - 1)
+    MAX_SEQ_NUM = 2147483647
+    # Lower bound on the retransmission timeout in seconds, well above the
+    # time a receiver may hold back a delayed ACK
+    MIN_TIMEOUT = 0.05
+    # Upper bound on the retransmission timeout in seconds
+    MAX_TIMEOUT = 60.0
+
+    def __init__(self, estimated_RTT, dev_RTT, timeout_interval, congestion=None):
+        """
+        Arguments:
+        estimated_RTT -- initial estimated RTT in seconds.
+        dev_RTT -- initial RTT deviation in seconds.
+        timeout_interval -- initial retransmission timeout in seconds.
+        congestion -- the peer's CongestionController. Defaults to a
+                      RenoController.
+
+        """
+        # Valid values are [1, 2147483647] (i.e., a 32-bit signed integer).
+        self.seq_number = 1
+        self.estimated_RTT = estimated_RTT
+        self.dev_RTT = dev_RTT
+        self.timeout_interval = timeout_interval
+        self.rtt_samples = 0
+        self.congestion = congestion if congestion is not None else RenoController()
+        self.pacer = TokenBucket(PACING_BURST)
+        self.packets_sent = 0
+        self.retransmits = 0
+        self.timeouts = 0
+        # Set once the peer has advertised support for the binary format
+        # (which also means it accepts datagrams larger than LEGACY_MTU)
+        self.binary = False
+        # Payload size for this peer; None means the Rdt instance default
+        self.mtu = None
+
+    def next_seq_number(self):
+        """
+        Returns the next sequence number to use and advances the sequence
+        space, wrapping around after MAX_SEQ_NUM.
+
+        """
+        seq_number = self.seq_number
+        if self.seq_number == self.MAX_SEQ_NUM:
+            self.seq_number = 1
+        else:
+            self.seq_number += 1
+
+        return seq_number
+
+    def update_RTT(self, sample_RTT):
+        """
+        Updates the RTT estimates and the retransmission timeout from a new
+        RTT sample (in seconds), as described in RFC 6298.
+
+        """
+        if self.rtt_samples == 0:
+            self.estimated_RTT = sample_RTT
+            self.dev_RTT = sample_RTT / 2
+        else:
+            self.estimated_RTT *= 0.875
+            self.estimated_RTT += (0.125 * sample_RTT)
+            self.dev_RTT *= 0.75
+            self.dev_RTT += (0.25 * abs(sample_RTT - self.estimated_RTT))
+        self.rtt_samples += 1
+        RTT_SECONDS.observe(sample_RTT)
+        self.timeout_interval = min(self.MAX_TIMEOUT,
+                                    max(self.MIN_TIMEOUT, self.estimated_RTT + 4 * self.dev_RTT))
+
+    def window(self, window_size):
+        """
+        Returns the number of packets that may be in flight: window_size,
+        limited by the congestion window.
+
+        """
+        return max(1, min(window_size, int(self.congestion.cwnd)))
+
+    def pacing_delay(self):
+        """
+        Takes a token for one packet from the pacer.
+
+        Returns:
+        The number of seconds to wait before sending the packet.
+
+        """
+        self.pacer.rate = self.congestion.pacing_rate(self.estimated_RTT)
+        return self.pacer.consume()
+
+    def on_send(self, retransmit=False):
+        """
+        Called when a data packet has been sent.
+
+        """
+        self.packets_sent += 1
+        PACKETS_OUT.inc()
+        if retransmit:
+            self.retransmits += 1
+            RETRANSMITS.inc()
+
+    def on_ack(self, acked):
+        """
+        Called when acked packets have been acknowledged.
+
+        """
+        self.congestion.on_ack(acked, self.estimated_RTT)
+
+    def on_timeout(self):
+        """
+        Called when a retransmission timer expires. Doubles the timeout, up to
+        MAX_TIMEOUT, and reports the loss to the congestion controller.
+
+        """
+        self.timeouts += 1
+        TIMEOUTS.inc()
+        self.timeout_interval = min(self.MAX_TIMEOUT, self.timeout_interval * 2)
+        self.congestion.on_loss(time.monotonic(), self.estimated_RTT)
+
+    def stats(self):
+        """
+        Returns the peer's RTT estimates, congestion state and counters as a
+        dict.
+
+        """
+        stats = {"estimated_RTT": self.estimated_RTT,
+                 "dev_RTT": self.dev_RTT,
+                 "timeout_interval": self.timeout_interval,
+                 "pacing_rate": self.pacer.rate,
+                 "packets_sent": self.packets_sent,
+                 "retransmits": self.retransmits,
+                 "timeouts": self.timeouts}
+        stats.update(self.congestion.stats())
+
+        return stats
+
+
+class SenderState(PeerState):
+    """
+    PeerState of the threaded Rdt, which also owns the socket used to send
+    packets to (and receive ACKs from) the peer. Sends to the same peer are
+    serialized by the state's lock; sends to different peers proceed in
+    parallel, since each peer's ACKs arrive on its own socket.
+
+    """
+    def __init__(self, estimated_RTT, dev_RTT, timeout_interval, congestion=None):
+        PeerState.__init__(self, estimated_RTT, dev_RTT, timeout_interval, congestion)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        # Set once the state has been evicted and its socket closed
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
+
+
+class RdtBase(object):
+    """
+    The transport-independent half of the protocol: building and parsing
+    packets, acknowledging them and reassembling received messages.
+    Subclasses provide the I/O through sendto and deliver.
+
+    """
+    def __init__(self, hostname, window_size=1, wire_format="text", mtu=LEGACY_MTU,
+                 ack_every=1):
         """
         Initialize default values.
 
         Arguments:
         hostname -- hostname of this (sending) client.
+        window_size -- maximum number of unacknowledged packets in flight per
+                       message. A window of 1 is plain stop-and-wait.
+        wire_format -- "text" or "binary". With "binary", messages to a peer
+                       switch to the binary header once the peer has
+                       advertised support for it; until then, and for older
+                       peers, the text header is used. Both formats are
+                       always accepted on receive.
+        mtu -- default payload size, in bytes, of each packet. It can be
+               overridden per peer.
+        ack_every -- with a value greater than one, in-order data packets of
+                     binary messages sent with a window (marked with
+                     FLAG_WINDOW) are acknowledged with one cumulative ACK
+                     per ack_every packets, or after ack_delay seconds.
+                     Other packets, including all text packets and those of
+                     stop-and-wait senders, are always acknowledged
+                     immediately, as are the SYN, FIN and any out-of-order
+                     packet.
 
         """
+        if wire_format not in ("text", "binary"):
+            raise ValueError("Unknown wire format: {}".format(wire_format))
         self.hostname = hostname
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.listen_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.message_queue = queue.Queue()
-        self.stdout_lock = threading.Lock()
+        self.host_hash = host_hash(hostname)
+        self.wire_format = wire_format
+        # msgkey -> ReassemblyBuffer of each incomplete message
         self.fragments = {}
-        self.MTU = 128
-        # Estimated RTT in seconds
+        # Incomplete messages idle for this many seconds are dropped
+        self.fragment_timeout = 60.0
+        # Number of incomplete messages dropped
+        self.evicted_fragments = 0
+        # Seconds between runs of reap
+        self.reap_interval = 10.0
+        self.MTU = int(mtu)
+        # Size of the buffers used to receive packets and ACKs
+        self.recv_buffer_size = MAX_DATAGRAM
+        # Initial RTT estimates in seconds for each new peer
         self.estimated_RTT = 0.1
         self.dev_RTT = 0.0
-        # Socket timeout interval in seconds
+        # Initial socket timeout interval in seconds for each new peer
         self.timeout_interval = 1.0
         # Maximum number of retransmission attempts for a packet
         self.max_retries = 3
-        # Maximum sequence number value (2^31 - 1)
-        self.MAX_SEQ_NUM = 2147483647
+        # Maximum number of unacknowledged packets in flight; the congestion
+        # window of each peer may allow fewer
+        self.window_size = max(1, int(window_size))
+        # Factory for each peer's CongestionController
+        self.congestion_control = RenoController
         # If a (host_id, comm_id) pair has already been processed
-        # add it to the list
-        self.closed_communications = []
+        # add it to the set
+        self.closed_communications = ClosedCommunications()
+        # Delayed ACKs
+        self.ack_every = max(1, int(ack_every))
+        self.ack_delay = 0.005
+        # msgkey -> [buffer, address, packets not yet ACKed, time of the first]
+        self.pending_acks = {}
+        self.ack_lock = threading.Lock()
+
+    def schedule_ack_flush(self):
+        """
+        Called when a message gets a delayed ACK pending. Transports that do
+        not poll flush_due_acks arrange for it to be called after ack_delay.
+
+        """
+        pass
+
+    def sendto_many(self, datagrams):
+        """
+        Sends a list of (data, address) tuples. Subclasses may send them in
+        one batch.
+
+        """
+        for data, address in datagrams:
+            self.sendto(data, address)
+
+    def sendto(self, data, address):
+        """
+        Sends a datagram (an ACK) from the receiving side.
+
+        """
+        raise NotImplementedError
+
+    def deliver(self, message):
+        """
+        Hands a reassembled message to the upper layer.
+
+        """
+        raise NotImplementedError
+
+    def accepting_messages(self):
+        """
+        Returns False while the upper layer has no room for another message.
+        The FIN packets that would complete a message are then dropped
+        without an ACK, so their senders retransmit them later.
+
+        """
+        return True
+
+    def make_packets(self, sender, comm_id, data):
+        """
+        Creates packets containing the payload from the upper layer for
+        transmission to the receiver. Data is split into chunks of at most MTU
+        bytes (each of which will be the payload for an individual packet) and
+        a header is created for each chunk. Chunks are memoryview slices of
+        data, so the data is not copied; the header and payload are only
+        joined by the socket's scatter-gather send. Text packets end on UTF-8
+        character boundaries, as older receivers decode each one on its own.
+
+        Arguments:
+        sender -- The PeerState whose sequence space numbers the packets.
+        comm_id -- The communication ID associated with this message. Used to
+                   keep track of separate messages from the same host.
+        data -- The payload to be sent, as a bytes-like object. It must not be
+                modified until the message has been sent.
+
+        Returns:
+        Yields a tuple containing the current header (as a list of strings)
+        and the packet as a tuple of buffers: the encoded header and the
+        payload. The binary format is used if it is enabled and the peer
+        supports it; the choice is made once per message.
+
+        """
+        binary = self.wire_format == "binary" and sender.binary
+        window_bit = FLAG_WINDOW if self.window_size > 1 else 0
+        mtu = self.peer_mtu(sender)
+        view = memoryview(data).cast("B")
+        data_length = len(view)
+        start = 0
+        while start < data_length:
+            end = min(start + mtu, data_length)
+            if not binary and end < data_length:
+                end = utf8_boundary(view, start, end)
+            flags = ""
+            if start == 0:
+                # First packet
+                flags += "SYN"
+            if end == data_length:
+                # Last packet
+                flags += "FIN"
+
+            payload = view[start:end]
+
+            seq_number = sender.next_seq_number()
+            header = [self.hostname, str(comm_id), str(seq_number), flags]
+            if binary:
+                bits = (window_bit | (FLAG_SYN if start == 0 else 0) |
+                        (FLAG_FIN if end == data_length else 0))
+                prefix = BINARY_HEADER.pack(BINARY_MAGIC, bits, self.host_hash, comm_id,
+                                            seq_number, len(payload), zlib.crc32(payload))
+            else:
+                prefix = "{0} {1} {2} {3} ".format(header[0], header[1], header[2], header[3])
+                prefix = prefix.encode()
+
+            yield (header, (prefix, payload))
+            start = end
+
+    def peer_mtu(self, sender):
+        """
+        Returns the payload size to use for the peer of the given PeerState.
+
+        """
+        mtu = sender.mtu or self.MTU
+        if not sender.binary:
+            # The peer may be an older receiver with a 1024-byte buffer
+            mtu = min(mtu, LEGACY_MTU)
+
+        return mtu
+
+    def process_pkt(self, data, address):
+        """
+        Decodes and processes the packet.
+
+        Arguments:
+        data -- Complete packet fresh from the socket as a bytestring.
+        address -- The address tuple of the incoming connection.
+
+        """
+        PACKETS_IN.inc()
+        header, payload = self.extract(data)
+        if header is None:
+            # Corrupt packet; let the sender retransmit it
+            return
+        self.process_fragment(header, payload, address, data[0] == BINARY_MAGIC)
+
+    def process_fragment(self, header, payload, address, binary=False):
+        """
+        Acknowledges a parsed data packet and adds its payload to the message
+        it belongs to.
+
+        Arguments:
+        header -- the packet's header as returned by extract.
+        payload -- the packet's payload.
+        address -- The address tuple of the incoming connection.
+        binary -- True if the packet used the binary format.
+
+        """
+        msgkey = (header[0], header[1])
+        if PROBE in header[3] or msgkey in self.closed_communications:
+            # A probe, or a retransmitted fragment of a message we've already
+            # delivered
+            self.send_ack(header, address, binary)
+            return
+        if "FIN" in header[3] and not self.accepting_messages():
+            MESSAGES_REFUSED.inc()
+            return
+        buffer = self.fragments.get(msgkey)
+        if buffer is None:
+            buffer = self.fragments[msgkey] = ReassemblyBuffer()
+        seq = int(header[2])
+        # The ACK thread reads the buffer's state under ack_lock
+        with self.ack_lock:
+            complete = buffer.add(seq, header[3], payload)
+
+        delayed = False
+        if binary and self.ack_every > 1 and header[3] == "WIN" and not complete:
+            delayed = self.delay_ack(msgkey, buffer, seq, address)
+        if not delayed:
+            self.flush_ack(msgkey)
+            self.send_ack(header, address, binary)
+
+        if complete:
+            self.reassemble_message(msgkey)
+
+    def delay_ack(self, msgkey, buffer, seq, address):
+        """
+        Defers the ACK of an in-order packet until ack_every packets of its
+        message are pending, then sends one cumulative ACK for all of them.
+
+        Returns:
+        False if the packet is out of order and must be ACKed now, else True.
+
+        """
+        with self.ack_lock:
+            if not buffer.contiguous(seq):
+                return False
+            pending = self.pending_acks.get(msgkey)
+            if pending is None:
+                pending = self.pending_acks[msgkey] = [buffer, address, 0, time.monotonic()]
+                self.schedule_ack_flush()
+            pending[2] += 1
+            if pending[2] < self.ack_every:
+                return True
+            del self.pending_acks[msgkey]
+            ack = self.make_cumulative_ack(msgkey, buffer)
+        self.sendto(ack, address)
+
+        return True
+
+    def flush_ack(self, msgkey):
+        """
+        Sends the pending cumulative ACK of a message, if it has one.
+
+        """
+        with self.ack_lock:
+            pending = self.pending_acks.pop(msgkey, None)
+            if pending is None:
+                return
+            ack = self.make_cumulative_ack(msgkey, pending[0])
+        self.sendto(ack, pending[1])
+
+    def flush_due_acks(self):
+        """
+        Sends the cumulative ACKs that have been pending for ack_delay seconds.
+
+        Returns:
+        The number of messages that still have an ACK pending.
+
+        """
+        cutoff = time.monotonic() - self.ack_delay
+        acks = []
+        with self.ack_lock:
+            for msgkey, pending in list(self.pending_acks.items()):
+                if pending[3] <= cutoff:
+                    del self.pending_acks[msgkey]
+                    acks.append((self.make_cumulative_ack(msgkey, pending[0]), pending[1]))
+            remaining = len(self.pending_acks)
+        self.sendto_many(acks)
+
+        return remaining
+
+    def make_cumulative_ack(self, msgkey, buffer):
+        """
+        Returns a binary cumulative ACK for the given message.
+
+        """
+        cum_seq, sack = buffer.ack_state()
+        payload = "{:08x}".format(sack).encode()
+
+        return BINARY_HEADER.pack(BINARY_MAGIC, FLAG_ACK | FLAG_CUMULATIVE, self.host_hash,
+                                  int(msgkey[1]), cum_seq, len(payload),
+                                  zlib.crc32(payload)) + payload
+
+    def extract(self, data):
+        """
+        Extracts the upper-layer message payload from the packet.
+
+        For text packets the header fields: pkt_host, pkt_commid, pkt_seq,
+        and pkt_flags are the first four space-separated fields, and
+        everything after the fourth space is the payload, which is sliced from
+        a memoryview without decoding it. Binary packets are handed to
+        extract_binary.
+
+        Arguments:
+        data -- An RDT packet as a bytestring.
+
+        Returns:
+        A tuple containing the RDT header(as a list) and the upper-layer
+        message payload as a bytes-like object, or (None, None) for a corrupt
+        binary packet.
+
+        """
+        if data[0] == BINARY_MAGIC:
+            return self.extract_binary(data)
+
+        end = 0
+        for i in range(4):
+            end = data.find(b" ", end) + 1
+            if end == 0:
+                # No payload, as in a text ACK
+                return (data.decode().split(" ")[:4], b"")
+        # pkt_host, pkt_commid, pkt_seq, pkt_flags
+        pkt_header = data[:end - 1].decode().split(" ")
+
+        return (pkt_header, memoryview(data)[end:])
+
+    def extract_binary(self, data):
+        """
+        Extracts the header and payload of a binary packet. The header is
+        unpacked in place and the payload is sliced from a memoryview, so the
+        packet is not copied.
+
+        The host field of the returned header is the sender's host id hash
+        as eight hex digits, and the flags field has the same text form used
+        by the text format.
+
+        Arguments:
+        data -- A binary RDT packet as a bytestring.
+
+        Returns:
+        A tuple containing the RDT header (as a list) and the upper-layer
+        message payload as a memoryview, or (None, None) if the packet is
+        truncated or fails its checksum.
+
+        """
+        view = memoryview(data)
+        if len(view) < BINARY_HEADER.size:
+            return (None, None)
+        magic, flags, host, comm_id, seq, length, checksum = BINARY_HEADER.unpack_from(view)
+        payload = view[BINARY_HEADER.size:BINARY_HEADER.size + length]
+        if len(payload) != length or zlib.crc32(payload) != checksum:
+            return (None, None)
+
+        pkt_header = ["{:08x}".format(host), str(comm_id), str(seq), FLAG_NAMES[flags & 0x1f]]
+
+        return (pkt_header, payload)
+
+    def send_ack(self, header, address, binary=False):
+        """
+        Acknowledges a packet in the format it was received in. Text ACKs
+        advertise that this receiver also understands the binary format.
+
+        """
+        if binary:
+            bits = FLAG_ACK
+            if "SYN" in header[3]:
+                bits |= FLAG_SYN
+            if "FIN" in header[3]:
+                bits |= FLAG_FIN
+            ack = BINARY_HEADER.pack(BINARY_MAGIC, bits, self.host_hash, int(header[1]),
+                                     int(header[2]), 0, 0)
+        else:
+            ack = "{} {} {} {}ACK{}".format(self.hostname, header[1], header[2], header[3],
+                                            BINARY_CAPABLE).encode()
+        self.sendto(ack, address)
+
+    def reassemble_message(self, msgkey):
+        buffer = self.fragments.pop(msgkey)
+        self.closed_communications.add(msgkey)
+        MESSAGES_IN.inc()
+        REASSEMBLY_SECONDS.observe(time.monotonic() - buffer.created)
+
+        self.deliver(buffer.message())
+
+    def reap(self):
+        """
+        Drops incomplete messages that have not received a fragment for
+        fragment_timeout seconds, and expires old closed_communications
+        entries. Called every reap_interval seconds by the transport.
+
+        Returns:
+        The number of incomplete messages dropped.
+
+        """
+        cutoff = time.monotonic() - self.fragment_timeout
+        count = 0
+        for msgkey, buffer in list(self.fragments.items()):
+            if buffer.last_active < cutoff:
+                self.fragments.pop(msgkey, None)
+                count += 1
+        self.evicted_fragments += count
+        self.closed_communications.expire()
+
+        return count
+
+    def process_response(self, sender, response, comm_id, outstanding):
+        """
+        Returns the sequence numbers in outstanding acknowledged by the
+        response packet (none if it is not an ACK for comm_id). Records
+        whether the peer has advertised support for the binary format.
+
+        """
+        in_header, in_payload = self.extract(response)
+
+        if in_header is not None and BINARY_CAPABLE in in_header[3]:
+            sender.binary = True
+
+        return self.acked_seqs(in_header, in_payload, comm_id, outstanding)
+
+    def acked_seqs(self, header, payload, comm_id, outstanding):
+        """
+        Returns the sequence numbers in outstanding acknowledged by a parsed
+        packet, which acknowledges nothing unless it is an ACK for comm_id.
+
+        Arguments:
+        header, payload -- the packet as returned by extract.
+        comm_id -- The communication ID of the message being sent.
+        outstanding -- sequence numbers of the unacknowledged packets.
+
+        """
+        if header is None or "ACK" not in header[3] or header[1] != str(comm_id):
+            return []
+        seq = int(header[2])
+        if "CUM" not in header[3]:
+            return [seq] if seq in outstanding else []
+
+        sack = int(bytes(payload), 16)
+        acked = []
+        for out_seq in outstanding:
+            offset = (out_seq - seq) % PeerState.MAX_SEQ_NUM
+            if offset == 0 or offset > PeerState.MAX_SEQ_NUM // 2:
+                # At or before the cumulative seq
+                acked.append(out_seq)
+            elif offset <= SACK_BITS and sack & (1 << (offset - 1)):
+                acked.append(out_seq)
+
+        return acked
+
+    def now(self):
+        """
+        Returns the current time. Used for logging and debugging purposes.
+
+        """
+        return time.ctime(time.time())
+
+
+class Rdt(RdtBase):
+    """
+    RDT over blocking UDP sockets, with a thread pool processing received
+    packets.
+
+    """
+    def __init__(self, hostname, window_size=1, wire_format="text", mtu=LEGACY_MTU,
+                 workers=4, ack_every=1, rcvbuf=None, sndbuf=None, message_queue_size=1024):
+        """
+        Initialize default values.
+
+        Arguments:
+        hostname, window_size, wire_format, mtu, ack_every -- as for RdtBase.
+            The payload size can be overridden per peer with set_peer_mtu or
+            probe_mtu.
+        workers -- number of threads processing received packets.
+        rcvbuf, sndbuf -- kernel receive and send buffer sizes, in bytes, of
+                          the sockets. A larger rcvbuf lets bursts wait for
+                          the listen thread instead of being dropped. None
+                          keeps the system default.
+        message_queue_size -- number of received messages that may wait for
+                              receive_data. While that many are waiting, no
+                              further message is completed.
+
+        """
+        RdtBase.__init__(self, hostname, window_size, wire_format, mtu, ack_every)
+        # Used to send ACKs; data is sent through the per-peer SenderState
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listen_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.message_queue = queue.Queue(message_queue_size)
+        self.stdout_lock = threading.Lock()
+        # Received packets are handed to a fixed pool of worker threads. All
+        # packets of one (host_id, comm_id) message go to the same worker,
+        # so each message's fragments are only ever touched by one thread.
+        self.workers = max(1, int(workers))
+        self.worker_queues = []
+        # Packets arriving while this many lists of packets are queued for a
+        # worker are dropped (and will be retransmitted by the sender)
+        self.worker_queue_size = 1024
+        self.dropped_packets = 0
+        # Datagrams read by the listen thread per system call
+        self.batch_size = 32
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
+        mmsg.set_buffer_sizes(self.sock, sndbuf=sndbuf)
+        mmsg.set_buffer_sizes(self.listen_sock, rcvbuf, sndbuf)
+        # ACKs of the packets a worker is processing, sent as one batch
+        self.ack_batches = threading.local()
+        # Set while delayed ACKs are pending, so that ack_thread only polls
+        # when there is something to flush
+        self.acks_pending = threading.Event()
+        # Sender state for each destination address, least recently used
+        # first. Each holds a socket, so idle ones are closed by reap after
+        # sender_timeout seconds, and the least recently used idle ones as
+        # soon as there are more than max_senders.
+        self.senders = OrderedDict()
+        self.senders_lock = threading.Lock()
+        self.sender_timeout = 300.0
+        self.max_senders = 1024
+        # Seconds probe_mtu waits for the ACK of each probe packet. Fixed
+        # rather than the peer's RTO, which backs off on every lost probe.
+        self.probe_timeout = 0.2
+        # address -> settings kept from the closed SenderState of each peer
+        # (see PEER_SETTINGS), least recently used first, used to seed the
+        # peer's next SenderState. Holds at most max_peer_settings peers.
+        self.peer_settings = OrderedDict()
+        self.max_peer_settings = 65536
+
+    def schedule_ack_flush(self):
+        self.acks_pending.set()
+
+    def sendto(self, data, address):
+        batch = getattr(self.ack_batches, "acks", None)
+        if batch is not None:
+            batch.append((data, address))
+        else:
+            self.sock.sendto(data, address)
+
+    def sendto_many(self, datagrams):
+        mmsg.send_batch(self.sock, datagrams)
+
+    def deliver(self, message):
+        self.message_queue.put(message)
+
+    def accepting_messages(self):
+        return not self.message_queue.full()
+
+    def get_sender(self, address):
+        """
+        Returns the SenderState for the given destination address, creating it
+        on first use with the settings kept from the peer's previous one.
+
+        """
+        with self.senders_lock:
+            sender = self.senders.get(address)
+            if sender is None:
+                sender = SenderState(self.estimated_RTT, self.dev_RTT,
+                                     self.timeout_interval, self.congestion_control())
+                mmsg.set_buffer_sizes(sender.sock, self.rcvbuf, self.sndbuf)
+                settings = self.peer_settings.pop(address, None)
+                if settings is not None:
+                    for name, value in settings.items():
+                        setattr(sender, name, value)
+                self.senders[address] = sender
+                excess = len(self.senders) - self.max_senders
+                if excess > 0:
+                    for old_address in list(self.senders)[:-1]:
+                        if excess <= 0:
+                            break
+                        if self.evict_sender(old_address):
+                            excess -= 1
+            else:
+                self.senders.move_to_end(address)
+
+        return sender
+
+    @contextmanager
+    def sending_to(self, address):
+        """
+        Context manager giving the caller exclusive use of the SenderState
+        for address, which is not evicted until the block ends.
+
+        """
+        while True:
+            sender = self.get_sender(address)
+            sender.lock.acquire()
+            if not sender.closed:
+                break
+            # Evicted between get_sender and acquiring its lock
+            sender.lock.release()
+        try:
+            yield sender
+        finally:
+            sender.last_used = time.monotonic()
+            sender.lock.release()
+
+    def evict_sender(self, address):
+        """
+        Closes and forgets the SenderState for address unless a send to it is
+        in progress, keeping its settings for the peer's next SenderState.
+        Called with senders_lock held.
+
+        Returns:
+        True if the state was evicted.
+
+        """
+        sender = self.senders[address]
+        if not sender.lock.acquire(False):
+            return False
+        try:
+            del self.senders[address]
+            sender.close()
+            self.keep_settings(address, {name: getattr(sender, name) for name in PEER_SETTINGS})
+        finally:
+            sender.lock.release()
+
+        return True
+
+    def keep_settings(self, address, settings):
+        """
+        Stores the settings of a peer without a SenderState, forgetting those
+        of the least recently used peers beyond max_peer_settings. Called
+        with senders_lock held.
+
+        """
+        self.peer_settings[address] = settings
+        self.peer_settings.move_to_end(address)
+        while len(self.peer_settings) > self.max_peer_settings:
+            self.peer_settings.popitem(last=False)
+
+    def release_sender(self, address):
+        """
+        Closes the SenderState for address, if it has one and no send to it
+        is in progress. Called when the peer is known to have gone away.
+
+        """
+        with self.senders_lock:
+            if address in self.senders:
+                self.evict_sender(address)
+
+    def reap(self):
+        """
+        Drops stale incomplete messages, as RdtBase.reap does, and closes the
+        SenderStates not used for sender_timeout seconds.
+
+        Returns:
+        The number of incomplete messages dropped.
+
+        """
+        count = RdtBase.reap(self)
+        cutoff = time.monotonic() - self.sender_timeout
+        with self.senders_lock:
+            for address, sender in list(self.senders.items()):
+                if sender.last_used < cutoff:
+                    self.evict_sender(address)
+
+        return count
 
     def send(self, comm_id, data, address):
         """
-        Method called from upper layer to handle message. Complete RDT packets
-        are transmitted via UDP.
+        Method called from upper layer to handle message. The message is
+        encoded as UTF-8 and sent with send_bytes.
 
         Arguments:
+        comm_id -- The communication ID associated with this message.
         data -- the (unencoded) upper-layer data to transmit.
         address -- the destination IP address/FQDN and port passed as a
                    2-tuple.
@@ -60,7 +1249,47 @@ class Rdt(object):
         True if upper-layer data was sent successfully, else returns False.
 
         """
-        for header, packet in self.make_packets(comm_id, data):
+        return self.send_bytes(comm_id, data.encode(), address)
+
+    def send_bytes(self, comm_id, data, address):
+        """
+        Sends a message given as a bytes-like object. Complete RDT packets
+        are transmitted via UDP. Concurrent calls are safe; calls for the same
+        address are serialized.
+
+        Arguments:
+        comm_id -- The communication ID associated with this message.
+        data -- the upper-layer data to transmit, as bytes, a bytearray or a
+                memoryview. It is sent without being copied, so it must not
+                be modified until send_bytes returns.
+        address -- the destination IP address/FQDN and port passed as a
+                   2-tuple.
+
+        Returns:
+        True if upper-layer data was sent successfully, else returns False.
+
+        """
+        with self.sending_to(address) as sender:
+            if self.window_size > 1:
+                return self.send_window(sender, comm_id, data, address)
+
+            return self.send_stop_and_wait(sender, comm_id, data, address)
+
+    def send_stop_and_wait(self, sender, comm_id, data, address):
+        """
+        Sends each packet and waits for its ACK before sending the next one.
+
+        Arguments:
+        sender -- the SenderState for address.
+        comm_id, data, address -- as for send.
+
+        Returns:
+        True if upper-layer data was sent successfully, else returns False.
+
+        """
+        sock = sender.sock
+        for header, packet in self.make_packets(sender, comm_id, data):
+            seq = int(header[2])
             ack_seq = 0
             retries = 0
             sample_RTT = 0.0
@@ -68,85 +1297,264 @@ class Rdt(object):
                 if retries == self.max_retries:
                     # Reached maximum number of retransmissions.
                     # TODO: Send RST packet?
-                    self.sock.settimeout(None)  # Place socket in blocking mode
-                    self.increment_seq_number()
+                    sock.settimeout(None)  # Place socket in blocking mode
                     return False
 
                 #print("Sending to {} @ {}".format(address[0], address[1]))
-                self.sock.sendto(packet.encode(), address)
-                self.sock.settimeout(self.timeout_interval)
+                self.transmit(sender, packet, address, retries > 0)
+                sock.settimeout(sender.timeout_interval)
                 while True:
                     try:
                         start_time = time.perf_counter()
-                        response = self.sock.recv(1024)
+                        response = sock.recv(self.recv_buffer_size)
                         sample_RTT = time.perf_counter() - start_time
-                        ack_seq = self.process_response(header, response)
-                        if ack_seq == Rdt.seq_number or ack_seq == 0:
+                        if self.process_response(sender, response, comm_id, (seq,)):
                             # Keep only packets with the correct seq_number,
                             # drop other packets
+                            ack_seq = seq
+                            sender.on_ack(1)
                             break
-                    except:
+                    except socket.timeout:
                         # Transmission timed-out
-                        # TODO: Catch only timeout exceptions
-                        self.timeout_interval *= 2
+                        sender.on_timeout()
                         ack_seq = 0
                         break
                 retries += 1
 
             if retries == 1:
                 # Packet was successfully sent and acknowledged on first try
-                self.estimated_RTT *= 0.875
-                self.estimated_RTT += (0.125 * sample_RTT)
-                self.dev_RTT *= 0.75
-                self.dev_RTT += (0.25 * abs(sample_RTT - self.estimated_RTT))
-                self.timeout_interval = self.estimated_RTT + 4 * self.dev_RTT
-            self.sock.settimeout(None)  # Place socket in blocking mode
-            self.increment_seq_number()
+                sender.update_RTT(sample_RTT)
+            sock.settimeout(None)  # Place socket in blocking mode
 
         return True
 
-    def increment_seq_number(self):
-        if Rdt.seq_number == self.MAX_SEQ_NUM:
-            Rdt.seq_number = 1
-        else:
-            Rdt.seq_number += 1
+    def send_window(self, sender, comm_id, data, address):
+        """
+        Pipelined (selective repeat) version of send, used when window_size is
+        greater than one. Up to window_size packets are in flight at once and
+        each one has its own retransmission timer. Receivers already ACK every
+        packet individually, so the wire format is unchanged.
+
+        The SYN and FIN packets are sent with an otherwise empty window, so the
+        receiver always sees the SYN before any other fragment and the FIN
+        after all of them, just as it would with stop-and-wait.
+
+        Arguments:
+        sender -- the SenderState for address.
+        comm_id, data, address -- as for send.
+
+        Returns:
+        True if upper-layer data was sent successfully, else returns False.
 
-    def make_packets(self, comm_id, data):
         """
-        Creates packets containing the payload from the upper layer for
-        transmissiond to the receiver. Data is split into MTU-byte chunks (each
-        of which will be the payload for an individual packet), creates a
-        header for each chunk, and makes a packet by prepending the header to
-        the payload.
+        # seq_number -> [packet, time of last transmission, transmissions]
+        in_flight = {}
+        try:
+            for header, packet in self.make_packets(sender, comm_id, data):
+                seq = int(header[2])
+                barrier = header[3] != ""
+                while len(in_flight) > (0 if barrier else sender.window(self.window_size) - 1):
+                    if not self.await_ack(sender, comm_id, in_flight, address):
+                        return False
+
+                self.transmit(sender, packet, address)
+                in_flight[seq] = [packet, time.perf_counter(), 1]
+
+                while barrier and in_flight:
+                    if not self.await_ack(sender, comm_id, in_flight, address):
+                        return False
+
+            while in_flight:
+                if not self.await_ack(sender, comm_id, in_flight, address):
+                    return False
+        finally:
+            sender.sock.settimeout(None)  # Place socket in blocking mode
+
+        return True
+
+    def await_ack(self, sender, comm_id, in_flight, address):
+        """
+        Waits for a single ACK, or for the earliest retransmission timer in the
+        window to expire, and updates the window accordingly. Acknowledged
+        packets are removed from in_flight; expired packets are retransmitted.
 
         Arguments:
-        comm_id -- The communication ID associated with this message. Used to
-                   keep track of separate messages from the same host.
-        data -- The (unencoded) payload to be sent in this packet.
+        sender -- the SenderState for address.
+        comm_id -- The communication ID of the message being sent.
+        in_flight -- dict mapping sequence numbers to [packet, send time,
+                     transmission count] for every unacknowledged packet.
+        address -- the destination address tuple.
 
         Returns:
-        Yields a tuple containing the current header and complete packet as
-        unencoded strings.
+        False if a packet has reached the maximum number of transmissions,
+        else True.
 
         """
-        data_length = len(data)
-        # Number of packets to be sent
-        num_packets = self.MTU * (ceil(data_length / self.MTU) - 1)
-        for i in range(0, data_length, self.MTU):
-            flags = ""
-            if i == 0:
-                # First packet
-                flags += "SYN"
-            if i == num_packets:
-                # Last packet
-                flags += "FIN"
+        sock = sender.sock
+        deadline = min(entry[1] for entry in in_flight.values()) + sender.timeout_interval
+        wait = deadline - time.perf_counter()
+        if wait > 0:
+            sock.settimeout(wait)
+            try:
+                response = sock.recv(self.recv_buffer_size)
+            except socket.timeout:
+                pass
+            else:
+                ack_time = time.perf_counter()
+                acked = [in_flight.pop(seq) for seq in
+                         self.process_response(sender, response, comm_id, in_flight)]
+                # Only sample packets that were never retransmitted, and of
+                # those the latest sent, which waited least for a delayed ACK
+                send_times = [entry[1] for entry in acked if entry[2] == 1]
+                if send_times:
+                    sender.update_RTT(ack_time - max(send_times))
+                if acked:
+                    sender.on_ack(len(acked))
+                return True
+
+        # Transmission timed-out
+        now = time.perf_counter()
+        expired = [entry for entry in in_flight.values()
+                   if now - entry[1] >= sender.timeout_interval]
+        sender.on_timeout()
+        for entry in expired:
+            if entry[2] == self.max_retries:
+                # Reached maximum number of retransmissions.
+                return False
+            self.transmit(sender, entry[0], address, True)
+            entry[1] = time.perf_counter()
+            entry[2] += 1
+
+        return True
+
+    def transmit(self, sender, packet, address, retransmit=False):
+        """
+        Sends a packet, given as a tuple of buffers by make_packets, to address
+        once the peer's pacer allows it.
+
+        """
+        delay = sender.pacing_delay()
+        if delay > 0:
+            time.sleep(delay)
+        sender.sock.sendmsg(packet, (), 0, address)
+        sender.on_send(retransmit)
+
+    def peer_stats(self):
+        """
+        Returns a dict mapping each destination address to the statistics of
+        its SenderState.
 
-            payload = data[i:i + self.MTU]
+        """
+        with self.senders_lock:
+            senders = list(self.senders.items())
+
+        return {address: sender.stats() for address, sender in senders}
+
+    def set_peer_mtu(self, address, mtu):
+        """
+        Sets the payload size used for messages sent to address. Passing None
+        reverts to the instance default.
+
+        """
+        with self.senders_lock:
+            sender = self.senders.get(address)
+            if sender is not None:
+                sender.mtu = mtu
+            else:
+                settings = self.peer_settings.get(address, {})
+                settings["mtu"] = mtu
+                self.keep_settings(address, settings)
+
+    def probe_mtu(self, address, low=512, high=8972):
+        """
+        Discovers the largest datagram that reaches address without IP
+        fragmentation and sets the peer's payload size to match.
 
-            header = [self.hostname, str(comm_id), str(Rdt.seq_number), flags]
-            packet = "{0} {1} {2} {3} {4}".format(header[0], header[1], header[2], header[3], payload)
+        Probe packets carry the PRB flag and are ACKed (and then discarded) by
+        receivers. Don't-fragment is set on the probing socket where the
+        platform supports it, so datagrams larger than the local interface
+        MTU fail immediately and those larger than the path MTU are dropped
+        on the way. A probe size is considered to fit if any of max_retries
+        attempts is ACKed within probe_timeout. Note that receivers
+        predating configurable packet sizes truncate datagrams to 1024 bytes
+        but still ACK them.
 
-            yield (header, packet)
+        A probe of low bytes is sent first. If the peer does not ACK it, the
+        peer is unreachable or does not answer probes, and probing stops
+        with the peer's payload size unchanged.
+
+        Sends to address wait while the peer is probed.
+
+        Arguments:
+        address -- the destination address tuple.
+        low -- datagram size, in bytes, assumed to always fit.
+        high -- largest datagram size, in bytes, to try.
+
+        Returns:
+        The new payload size for the peer, or None if the peer did not
+        answer.
+
+        """
+        # Room for the largest possible text header
+        overhead = len("{} {} {} {} ".format(self.hostname, SenderState.MAX_SEQ_NUM,
+                                             SenderState.MAX_SEQ_NUM, "SYNFIN").encode())
+        with self.sending_to(address) as sender:
+            sock = sender.sock
+            pmtu_discover = getattr(socket, "IP_MTU_DISCOVER", None)
+            if pmtu_discover is not None:
+                previous = sock.getsockopt(socket.IPPROTO_IP, pmtu_discover)
+                sock.setsockopt(socket.IPPROTO_IP, pmtu_discover, socket.IP_PMTUDISC_DO)
+            try:
+                if not self.send_probe(sender, address, low):
+                    return None
+                while low < high:
+                    size = (low + high + 1) // 2
+                    if self.send_probe(sender, address, size):
+                        low = size
+                    else:
+                        high = size - 1
+            finally:
+                if pmtu_discover is not None:
+                    sock.setsockopt(socket.IPPROTO_IP, pmtu_discover, previous)
+                sock.settimeout(None)  # Place socket in blocking mode
+
+            sender.mtu = max(1, low - overhead)
+
+        return sender.mtu
+
+    def send_probe(self, sender, address, size):
+        """
+        Sends a size-byte probe packet to address, up to max_retries times,
+        waiting probe_timeout seconds for its ACK after each.
+
+        Returns:
+        True if the probe was ACKed, else returns False.
+
+        """
+        seq = sender.next_seq_number()
+        header = "{} 0 {} {} ".format(self.hostname, seq, PROBE).encode()
+        packet = header + b"\0" * max(0, size - len(header))
+        for attempt in range(self.max_retries):
+            try:
+                sender.sock.sendto(packet, address)
+            except OSError as e:
+                if e.errno == errno.EMSGSIZE:
+                    return False
+                raise
+            deadline = time.perf_counter() + self.probe_timeout
+            while True:
+                wait = deadline - time.perf_counter()
+                if wait <= 0:
+                    break
+                sender.sock.settimeout(wait)
+                try:
+                    response = sender.sock.recv(self.recv_buffer_size)
+                except socket.timeout:
+                    break
+                if self.process_response(sender, response, 0, (seq,)):
+                    return True
+
+        return False
 
     def start_server(self, port):
         """
@@ -157,81 +1565,129 @@ class Rdt(object):
 
         """
         self.listen_sock.bind(('', port))
+        self.worker_queues = [queue.Queue(self.worker_queue_size) for i in range(self.workers)]
+        metrics.registry.gauge("rdt_worker_queue_depth", self.queue_depth)
+        metrics.registry.gauge("rdt_message_queue_depth", self.message_queue.qsize)
+        metrics.registry.gauge("rdt_dropped_packets", lambda: self.dropped_packets)
+        for worker_queue in self.worker_queues:
+            thread = threading.Thread(target=self.worker_thread, args=(worker_queue,))
+            thread.daemon = True
+            thread.start()
+        thread = threading.Thread(target=self.reaper_thread, args=())
+        thread.daemon = True
+        thread.start()
+        if self.ack_every > 1:
+            thread = threading.Thread(target=self.ack_thread, args=())
+            thread.daemon = True
+            thread.start()
         thread = threading.Thread(target=self.listen_thread, args=())
         thread.start()
         #_thread.start_new(self.listen_thread, ())
 
     def listen_thread(self):
         """
-        Listens to socket. Creates a new thread to handle received data.
+        Listens to socket, reading every datagram queued on it per wakeup.
+        Hands received data to the worker responsible for its (host_id,
+        comm_id) pair, one list of packets per worker and wakeup.
 
         """
-        while True:
-            data, address = self.listen_sock.recvfrom(1024)
-            if not data:
+        receiver = mmsg.BatchReceiver(self.listen_sock, self.batch_size, self.recv_buffer_size)
+        closed = False
+        while not closed:
+            try:
+                batch = receiver.recv()
+            except OSError:
+                # Socket was closed
                 break
-            thread = threading.Thread(target=self.process_pkt, args=(data, address))
-            thread.start()
+            packets = {}
+            for data, address in batch:
+                if not data:
+                    closed = True
+                    break
+                index = hash(self.dispatch_key(data)) % self.workers
+                packets.setdefault(index, []).append((data, address))
+            for index, items in packets.items():
+                try:
+                    self.worker_queues[index].put_nowait(items)
+                except queue.Full:
+                    self.dropped_packets += len(items)
 
-    def process_pkt(self, data, address):
-        """
-        Decodes and processes the packet.
-
-        Arguments:
-        data -- Complete packet fresh from the socket as a bytestring.
-        address -- The address tuple of the incoming connection.
+        for worker_queue in self.worker_queues:
+            worker_queue.put(None)
 
+    def worker_thread(self, worker_queue):
         """
-        header, payload = self.extract(data.decode())
-        self.send_ack(header, address)
-
-        if "SYN" in header[3]:
-            self.fragments[(header[0], header[1])] = {}
-        if (header[0], header[1]) in self.fragments:
-            self.fragments[(header[0], header[1])][header[2]] = payload
+        Processes lists of packets from worker_queue until it receives None.
+        The ACKs for each list are sent together once it has been processed.
 
-            if "FIN" in header[3]:
-                # If we get a FIN packet without a SYN packet, ignore it.
-                # This should mean a duplicate FIN that we've already processed.
-                self.reassemble_message((header[0], header[1]))
+        """
+        while True:
+            items = worker_queue.get()
+            if items is None:
+                break
+            acks = self.ack_batches.acks = []
+            for item in items:
+                try:
+                    self.process_pkt(*item)
+                except Exception:
+                    # Drop malformed packets
+                    continue
+            self.ack_batches.acks = None
+            try:
+                self.sendto_many(acks)
+            except OSError:
+                # Socket was closed
+                pass
 
-    def extract(self, data):
+    def reaper_thread(self):
         """
-        Extracts the upper-layer message payload from the packet.
+        Calls reap every reap_interval seconds.
 
-        This implementation creates a list of strings split by the space character.
-        The header fields: pkt_host, pkt_commid, pkt_seq, and pkt_flags are
-        extracted from the list. Then the data payload portion is reassembled by
-        joining the remaining items.
+        """
+        while True:
+            time.sleep(self.reap_interval)
+            try:
+                self.reap()
+            except Exception:
+                # Try again next time rather than never
+                continue
 
-        Arguments:
-        data -- An RDT packet.
+    def ack_thread(self):
+        """
+        Sends delayed ACKs once they have waited ack_delay seconds. Sleeps
+        while none are pending.
 
-        Returns:
-        A tuple containing the RDT header(as a list) and the upper-layer
-        message payload string.
+        """
+        while True:
+            self.acks_pending.wait()
+            time.sleep(self.ack_delay / 2)
+            try:
+                remaining = self.flush_due_acks()
+            except Exception:
+                # Keep flushing the other messages' ACKs
+                continue
+            if not remaining:
+                with self.ack_lock:
+                    if not self.pending_acks:
+                        self.acks_pending.clear()
 
+    def dispatch_key(self, data):
         """
-        split_pkt = [field for field in data.split(" ")]
-        # pkt_host, pkt_commid, pkt_seq, pkt_flags = split_pkt[:4]
-        pkt_header = split_pkt[:4]
-        pkt_payload = " ".join(split_pkt[4:])
+        Returns the raw (host_id, comm_id) portion of a packet's header, used to
+        pick the worker that processes it, without parsing the packet.
 
-        return (pkt_header, pkt_payload)
+        """
+        if data[0] == BINARY_MAGIC:
+            return data[2:10]
 
-    def send_ack(self, header, address):
-        ack_header = "{} {} {} {}ACK".format(self.hostname, header[1], header[2], header[3])
-        self.sock.sendto(ack_header.encode(), address)
+        return data[:data.find(b" ", data.find(b" ") + 1)]
 
-    def reassemble_message(self, msgkey):
-        if msgkey in self.closed_communications:
-            del self.fragments[msgkey]
-        else:
-            message = ''.join([self.fragments[msgkey][i] for i in sorted(self.fragments[msgkey], key=int)])
-            del self.fragments[msgkey]
-            self.closed_communications.append(msgkey)
+    def queue_depth(self):
+        """
+        Returns the number of received packets waiting for a worker.
 
-            self.message_queue.put(message)
+        """
+        return sum(worker_queue.qsize() for worker_queue in self.worker_queues)
 
     def close(self):
         """
@@ -239,31 +1695,29 @@ class Rdt(object):
 
         """
         self.sock.close()
+        try:
+            # Wakes up listen_thread, which closing the socket does not
+            self.listen_sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # Not connected, but blocked receives return all the same
+            pass
         self.listen_sock.close()
+        with self.senders_lock:
+            for sender in self.senders.values():
+                sender.close()
 
-    def now(self):
-        """
-        Returns the current time. Used for logging and debugging purposes.
-
-        """
-        return time.ctime(time.time())
-
-    def process_response(self, out_header, response):
+    def receive_data(self):
         """
-        Returns the sequence number of the response packet or 0 if the
-        response packet is not an ACK.
+        Called by upper layer to receive messages from the queue, decoded
+        from UTF-8.
 
         """
-        in_header = self.extract(response.decode())[0]
+        return self.receive_bytes().decode()
 
-        if "ACK" in in_header[3]:
-            return int(in_header[2])
-
-        return 0
-
-    def receive_data(self):
+    def receive_bytes(self):
         """
-        Called by upper layer to receive messages from the queue.
+        Called by upper layer to receive messages from the queue as bytes.
+        Raises queue.Empty if no message arrives within 5 seconds.
 
         """
         return self.message_queue.get(True, 5)
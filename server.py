@@ -6,14 +6,16 @@ Email: michael@mplang.net
 Date Modified: 3 December 2012
 
 Notes:
-    As it stands, the server doesn't check for duplicate files
-    shared by a given client.
+    A file shared again by the same client is ignored, as is a second
+    file of the same name; the first filesize reported is kept.
 """
 
 import sys
 import os
+import argparse
+import logging
+import logging.handlers
 import socket
-import sqlite3
 import time
 import queue
 import threading
@@ -22,6 +24,11 @@ import random
 import shlex
 
 import rdt
+import aiordt
+import dbpool
+import directory
+import expiry
+import metrics
 import servermsg
 
 # port to bind to
@@ -30,17 +37,74 @@ listen_port = 50001
 MAX_COMM_ID = 2147483647
 # Each message corresponds to a unique comm_id
 comm_id = random.randrange(MAX_COMM_ID)
+comm_id_lock = threading.Lock()
+
+# Number of RDT packets the server keeps in flight per reply
+rdt_window_size = 8
+# Use the compact binary RDT header with clients that support it
+rdt_wire_format = "binary"
+# RDT payload size per packet for clients that support large datagrams
+rdt_mtu = 1400
+# Acknowledge in-order binary packets with one cumulative ACK per this many
+rdt_ack_every = 4
+# Kernel receive buffer size of the RDT sockets, so that bursts from many
+# clients wait for the listen thread instead of being dropped
+rdt_rcvbuf = 4 * 1024 * 1024
+# Received messages waiting for the server loop. While this many are waiting
+# the RDT layer leaves further messages unacknowledged, so clients retransmit
+# them later rather than the server buffering without limit.
+rdt_message_queue_size = 1024
+
+r = rdt.Rdt(socket.gethostname(), rdt_window_size, rdt_wire_format, rdt_mtu, ack_every=rdt_ack_every,
+            rcvbuf=rdt_rcvbuf, message_queue_size=rdt_message_queue_size)
 
-r = rdt.Rdt(socket.gethostname())
-
-activity_tracker = {}
 dbname = "filedir.db"
 
 stdout_lock = threading.Lock()
 tracker_lock = threading.Lock()
+# Hosts not heard from for this many seconds are removed from the directory
+host_timeout = 3600
+# Time each (host_id, ip_address) was last heard from; the hosts that time
+# out are passed to expire_hosts
+activity_tracker = expiry.ExpiryScheduler(host_timeout, lambda hosts: expire_hosts(hosts),
+                                          tracker_lock)
 db_lock = threading.Lock()
+# Writes go through one connection serialized by db_lock; queries use a pool
+# of up to db_readers connections
+db_readers = 4
+db = dbpool.ConnectionManager(dbname, db_lock, db_readers)
+# The directory backend: "sqlite" keeps the directory in dbname, "memory"
+# keeps it in memory only
+directory_backend = "sqlite"
+# Number of QUERY results kept in the directory's cache
+query_cache_size = 1024
+# Largest page of results returned for a paged QUERY
+query_max_page = 500
+file_directory = directory.CachedDirectory(directory.SqliteDirectory(db), query_cache_size)
+
+# Received messages are handled by a pool of handler threads. All messages
+# from one host go to the same handler, so they are processed in order, while
+# other hosts' messages are handled in parallel.
+handler_workers = 8
+# Largest number of messages waiting for each handler. The server loop stops
+# taking messages from the RDT layer while the handler it needs is full; once
+# rdt_message_queue_size messages wait there, clients have to retransmit.
+handler_queue_size = 64
+handler_queues = []
 
 verbose = False
+# Events are logged through a queue and written to stdout by a background
+# thread, so handlers never wait on the console
+log = logging.getLogger("server")
+log_listener = None
+# Serve metrics over HTTP on localhost at this port, if set
+metrics_port = None
+metrics_server = None
+
+# Methods whose request latency is tracked separately
+METHODS = ("IDENT", "INFORM", "QUERY", "REMOVE", "EXIT")
+DIRECTORY_SECONDS = {op: metrics.registry.histogram("server_directory_seconds", op=op)
+                     for op in ("add", "query", "remove")}
 
 
 def now():
@@ -52,21 +116,58 @@ def now():
 
 
 def increment_comm_id():
+    """
+    Advances comm_id. Safe to call from several handler threads.
+
+    Returns:
+    The new comm_id, for the caller's next message.
+
+    """
     global comm_id
-    if comm_id == MAX_COMM_ID:
-        comm_id = 1
-    else:
-        comm_id += 1
+    with comm_id_lock:
+        if comm_id == MAX_COMM_ID:
+            comm_id = 1
+        else:
+            comm_id += 1
+
+        return comm_id
+
 
+def init_database(keep=False):
+    """
+    Prepares an empty directory, or with keep set, keeps the files shared
+    during the last run where the backend stores them.
+
+    """
+    migrated = file_directory.reset(keep)
+    if migrated:
+        log.info("\t-->Migrated %d entries from the old directory table.", migrated)
+
+
+def make_directory(backend):
+    """
+    Returns a new directory of the given backend, "sqlite" or "memory",
+    behind the query cache.
+
+    """
+    if backend == "memory":
+        return directory.CachedDirectory(directory.MemoryDirectory(), query_cache_size)
+
+    return directory.CachedDirectory(directory.SqliteDirectory(db), query_cache_size)
+
+
+def make_rdt(use_asyncio):
+    """
+    Returns a new RDT instance on the threaded or the asyncio transport.
+
+    """
+    if use_asyncio:
+        return aiordt.ThreadedAsyncRdt(socket.gethostname(), rdt_window_size, rdt_wire_format,
+                                       rdt_mtu, rdt_ack_every, rdt_message_queue_size)
 
-def init_database():
-    c = sqlite3.connect(dbname)
-    with c:
-        cursor = c.cursor()
-        cursor.execute("drop table if exists directory")
-        cursor.execute("""create table if not exists directory
-                       (hostid text, hostip text, filename text,
-                       filesize integer)""")
+    return rdt.Rdt(socket.gethostname(), rdt_window_size, rdt_wire_format, rdt_mtu,
+                   ack_every=rdt_ack_every, rcvbuf=rdt_rcvbuf,
+                   message_queue_size=rdt_message_queue_size)
 
 
 def stdin_listener():
@@ -89,6 +190,8 @@ def stdin_listener():
             reset_server()
             with stdout_lock:
                 print("\t-->Server reset complete!")
+        elif kybd_in[0] == "stats":
+            print_stats()
         elif kybd_in[0] == "status":
             connected_clients = get_db_clients()
             with stdout_lock:
@@ -99,6 +202,7 @@ def stdin_listener():
                 verbose = False
             else:
                 verbose = True
+            log.setLevel(logging.DEBUG if verbose else logging.INFO)
         else:
             with stdout_lock:
                 print("***Invalid Input!")
@@ -106,8 +210,7 @@ def stdin_listener():
 
 def reset_server():
     init_database()
-    global activity_tracker
-    activity_tracker = {}
+    activity_tracker.clear()
     increment_comm_id()
 
 
@@ -120,97 +223,134 @@ def process_message(message):
     msg = servermsg.ServerMsg()
 
     if method == "IDENT":
-        with stdout_lock:
-            print("==>Server received IDENT message from {} @ {} at {}.".
-                  format(client_id, client_ip_addr, now()))
-        activity_tracker[(client_id, client_ip_addr)] = time.time()
+        log.info("==>Server received IDENT message from %s @ %s at %s.",
+                 client_id, client_ip_addr, now())
+        activity_tracker.touch((client_id, client_ip_addr))
         msg.identok(client_id)
-        increment_comm_id()
-        with stdout_lock:
-            print("\t-->Sending IDENTOK message to {}.".format(client_id))
-            if verbose:
-                print(('*' * 25) + '\n' + repr(msg) + '\n' + ('*' * 25))
-        r.send(comm_id, repr(msg), (client_ip_addr, 60001))
+        reply_id = increment_comm_id()
+        log.info("\t-->Sending IDENTOK message to %s.", client_id)
+        log.debug("%s\n%s\n%s", '*' * 25, msg, '*' * 25)
+        r.send(reply_id, repr(msg), (client_ip_addr, 60001))
     elif method == "INFORM":
-        with stdout_lock:
-            print("==>Server received INFORM message from {} @ {} at {}.".
-                  format(client_id, client_ip_addr, now()))
+        log.info("==>Server received INFORM message from %s @ %s at %s.",
+                 client_id, client_ip_addr, now())
+        # Touched before the database is changed; see expire_hosts
+        activity_tracker.touch((client_id, client_ip_addr))
         num_entries = database_add(client_id, client_ip_addr, body)
-        print("\t-->Added {} entries to the database.".format(num_entries))
-        activity_tracker[(client_id, client_ip_addr)] = time.time()
+        log.info("\t-->Added %d entries to the database.", num_entries)
         msg.ok("INFORM", str(num_entries))
-        increment_comm_id()
-        with stdout_lock:
-            print("\t-->Sending INFORMOK message to {}.".format(client_id))
-            if verbose:
-                print(('*' * 25) + '\n' + repr(msg) + '\n' + ('*' * 25))
-        r.send(comm_id, repr(msg), (client_ip_addr, 60001))
+        reply_id = increment_comm_id()
+        log.info("\t-->Sending INFORMOK message to %s.", client_id)
+        log.debug("%s\n%s\n%s", '*' * 25, msg, '*' * 25)
+        r.send(reply_id, repr(msg), (client_ip_addr, 60001))
     elif method == "QUERY":
-        with stdout_lock:
-            print("==>Server received QUERY message from {}@{} at {}.".
-                  format(client_id, client_ip_addr, now()))
+        log.info("==>Server received QUERY message from %s@%s at %s.",
+                 client_id, client_ip_addr, now())
+        activity_tracker.touch((client_id, client_ip_addr))
         result_list = database_query(client_id, body)
-        with stdout_lock:
-            print("\t-->Server found {} query matches.".
-                  format(len(result_list)))
-        activity_tracker[(client_id, client_ip_addr)] = time.time()
-        msg.queryresponse(result_list)
-        increment_comm_id()
-        with stdout_lock:
-            print("\t-->Sending QUERYRESPONSE message to {}.".format(client_id))
-            if verbose:
-                print(('*' * 25) + '\n' + repr(msg) + '\n' + ('*' * 25))
-        r.send(comm_id, repr(msg), (client_ip_addr, 60001))
+        log.info("\t-->Server found %d query matches.", len(result_list))
+        page = query_page(body)
+        if page is None:
+            msg.queryresponse(result_list)
+        else:
+            limit, offset = page
+            msg.queryresponse(result_list[offset:offset + limit], offset, len(result_list))
+        reply_id = increment_comm_id()
+        log.info("\t-->Sending QUERYRESPONSE message to %s.", client_id)
+        log.debug("%s\n%s\n%s", '*' * 25, msg, '*' * 25)
+        r.send(reply_id, repr(msg), (client_ip_addr, 60001))
     elif method == "REMOVE":
-        with stdout_lock:
-            print("==>Server received REMOVE message from {}@{} at {}.".
-                  format(client_id, client_ip_addr, now()))
+        log.info("==>Server received REMOVE message from %s@%s at %s.",
+                 client_id, client_ip_addr, now())
+        activity_tracker.touch((client_id, client_ip_addr))
         num_entries = database_remove_files(client_id, body)
-        with stdout_lock:
-            print("\t-->Removed {} entries from the database.".format(num_entries))
-        activity_tracker[(client_id, client_ip_addr)] = time.time()
+        log.info("\t-->Removed %d entries from the database.", num_entries)
         msg.ok("REMOVE", str(num_entries))
-        with stdout_lock:
-            print("\t-->Sending REMOVEOK message to {}.".format(client_id))
-            if verbose:
-                print(('*' * 25) + '\n' + repr(msg) + '\n' + ('*' * 25))
+        log.info("\t-->Sending REMOVEOK message to %s.", client_id)
+        log.debug("%s\n%s\n%s", '*' * 25, msg, '*' * 25)
     elif method == "EXIT":
-        with stdout_lock:
-            print("==>Server received EXIT message from {}@{} at {}.".
-                  format(client_id, client_ip_addr, now()))
+        log.info("==>Server received EXIT message from %s@%s at %s.",
+                 client_id, client_ip_addr, now())
         num_entries = database_remove_host(client_id)
-        activity_tracker.pop((client_id, client_ip_addr), None)
-        with stdout_lock:
-            print("\t-->Removed {} from the database ({} entries).".format(host_id, num_entries))
+        activity_tracker.discard((client_id, client_ip_addr))
+        r.release_sender((client_ip_addr, 60001))
+        log.info("\t-->Removed %s from the database (%d entries).", client_id, num_entries)
+
+
+def start_handlers(workers, queue_size):
+    """
+    Starts the handler threads, each with its own queue of messages.
+
+    """
+    global handler_queues
+    handler_queues = [queue.Queue(queue_size) for i in range(max(1, workers))]
+    metrics.registry.gauge("server_handler_queue_depth",
+                           lambda: sum(handler_queue.qsize() for handler_queue in handler_queues))
+    for handler_queue in handler_queues:
+        thread = threading.Thread(target=handler_thread, args=(handler_queue,))
+        thread.daemon = True
+        thread.start()
+
+
+def dispatch(message):
+    """
+    Queues a received message for the handler responsible for its sender,
+    waiting while that handler's queue is full.
+
+    """
+    header = message.split("\r\n", 1)[0].split(' ')
+    host = header[1] if len(header) > 1 else ""
+    handler_queues[hash(host) % len(handler_queues)].put(message)
+
+
+def handler_thread(handler_queue):
+    """
+    Processes messages from handler_queue, one after the other.
+
+    """
+    while True:
+        message = handler_queue.get()
+        method = message.split(' ', 1)[0]
+        if method not in METHODS:
+            method = "other"
+        metrics.registry.counter("server_requests", method=method).inc()
+        try:
+            with metrics.registry.histogram("server_request_seconds", method=method).time():
+                process_message(message)
+        except Exception:
+            metrics.registry.counter("server_errors").inc()
+            log.exception("Unexpected error handling a %s message", method)
 
 
 def database_add(host_id, host_ip_addr, body):
-    file_list = [(' '.join(entry[:-1]), entry[-1]) for entry in [line.split(' ') for line in body]]
-    c = sqlite3.connect(dbname)
-    with c:
-        cur = c.cursor()
-        for line in file_list:
-            cur.execute("insert into directory(hostid, hostip, filename, filesize) values (?, ?, ?, ?)",
-                        (host_id, host_ip_addr, line[0], line[1]))
+    file_list = ((' '.join(entry[:-1]), entry[-1]) for entry in (line.split(' ') for line in body))
 
-    return c.total_changes
+    with DIRECTORY_SECONDS["add"].time():
+        return file_directory.add(host_id, host_ip_addr, file_list)
 
 
 def database_query(client_id, body):
     search_string, search_host = ([(' '.join(entry[:-1]), entry[-1])
                                   for entry in [line.split(' ') for line in body]][0])
-    c = sqlite3.connect(dbname)
-    with c:
-        cur = c.cursor()
-        if search_host:
-            cur.execute("select * from directory where filename like ? and hostid = ? and hostid != ?",
-                        ['%' + search_string + '%', search_host, client_id])
-        else:
-            cur.execute("select * from directory where filename like ? and hostid != ?",
-                        ['%' + search_string + '%', client_id])
-        rows = cur.fetchall()
 
-    return rows
+    with DIRECTORY_SECONDS["query"].time():
+        return file_directory.query(client_id, search_string, search_host)
+
+
+def query_page(body):
+    """
+    Returns the (limit, offset) requested on the second line of a QUERY body,
+    with limit capped at query_max_page, or None if the QUERY is not paged.
+
+    """
+    if len(body) < 2:
+        return None
+    try:
+        limit, offset = (int(value) for value in body[1].split(' '))
+    except ValueError:
+        return None
+
+    return (max(1, min(limit, query_max_page)), max(0, offset))
 
 
 def print_database_query(query_results):
@@ -226,67 +366,171 @@ def print_database_query(query_results):
 
 def database_remove_files(host_id, body):
     file_list = [(' '.join(entry[:-1]), entry[-1]) for entry in [line.split(' ') for line in body]]
-    c = sqlite3.connect(dbname)
-    with c:
-        cur = c.cursor()
-        for file in file_list:
-            cur.execute("delete from directory where filename = ? and hostid = ?", [file[0], host_id])
 
-    return c.total_changes
+    with DIRECTORY_SECONDS["remove"].time():
+        return file_directory.remove_files(host_id, [file[0] for file in file_list])
 
 
 def database_remove_host(host_id):
-    c = sqlite3.connect(dbname)
-    with c:
-        cur = c.cursor()
-        cur.execute("delete from directory where hostid = ?", [host_id])
+    return file_directory.remove_host(host_id)
+
+
+def expire_hosts(hosts):
+    """
+    Removes the hosts that have timed out from the database, in one
+    transaction. Called from the expiry thread.
 
-    return c.total_changes
+    A host that sent a message since it expired has been touched again, and
+    is kept. Handlers touch a host before changing its files, and the hosts
+    are removed with tracker_lock held, so a host's new files are either
+    added after the removal or keep the host from being removed.
+
+    Arguments:
+    hosts -- list of (host_id, ip_address) tuples.
+
+    """
+    try:
+        with tracker_lock:
+            hosts = [host for host in hosts if host not in activity_tracker.last_seen]
+            if not hosts:
+                return
+            with DIRECTORY_SECONDS["remove"].time():
+                file_directory.remove_hosts([host[0] for host in hosts])
+        for host in hosts:
+            log.info("Remove host from database: %s", host[0])
+        metrics.registry.counter("server_expired_hosts").inc(len(hosts))
+        # Replies to the host were sent from a socket of its own
+        for host in hosts:
+            r.release_sender((host[1], 60001))
+    except Exception:
+        log.exception("Unexpected error expiring hosts")
+
+
+def start_logging(level=logging.INFO):
+    """
+    Sends the server's log records through a queue to a thread that writes
+    them to stdout.
+
+    Returns:
+    The QueueListener, to be stopped before exiting so that the queue is
+    flushed.
+
+    """
+    log_queue = queue.Queue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.setLevel(level)
+    log.propagate = False
+    listener.start()
+
+    return listener
+
+
+def register_gauges():
+    """
+    Reports the host tracker's and the query cache's state as gauges.
+
+    """
+    metrics.registry.gauge("server_tracked_hosts", lambda: len(activity_tracker))
+    if hasattr(file_directory, "stats"):
+        for name in ("entries", "rows", "hits", "misses"):
+            metrics.registry.gauge("server_query_cache_" + name,
+                                   lambda name=name: file_directory.stats()[name])
+
+
+def print_stats():
+    snapshot = metrics.registry.snapshot()
+    with stdout_lock:
+        for name, value in sorted(snapshot["counters"].items()):
+            print("{} {}".format(name, value))
+        for name, value in sorted(snapshot["gauges"].items()):
+            print("{} {}".format(name, value))
+        for name, summary in sorted(snapshot["histograms"].items()):
+            if not summary["count"]:
+                continue
+            print("{} count={} mean={:.3f}ms p50<={:.3f}ms p99<={:.3f}ms max={:.3f}ms".
+                  format(name, summary["count"], summary["mean"] * 1e3, summary["p50"] * 1e3,
+                         summary["p99"] * 1e3, summary["max"] * 1e3))
 
 
 def get_db_clients():
-    c = sqlite3.connect(dbname)
-    with c:
-        cur = c.cursor()
-        cur.execute("select distinct hostid, hostip from directory")
-        current_clients = cur.fetchall()
+    current_clients = file_directory.clients()
 
     print(current_clients)
     return current_clients
 
 
 def server(listen_port):
+    global log_listener, metrics_server
     try:
+        log_listener = start_logging(logging.DEBUG if verbose else logging.INFO)
+        register_gauges()
+        if metrics_port is not None:
+            metrics_server = metrics.MetricsServer(metrics_port)
+            metrics_server.start()
+            log.info("Serving metrics at http://127.0.0.1:%d/metrics", metrics_server.port)
+        start_handlers(handler_workers, handler_queue_size)
+        activity_tracker.start()
         r.start_server(listen_port)
         stdin_thread = threading.Thread(target=stdin_listener, args=())
         stdin_thread.start()
         while True:
             # Server loop
-            curr_time = time.time()
-            for activity in activity_tracker:
-                if curr_time - activity_tracker[activity] > 3600:
-                    # Clean database of hosts with activity more than one hour ago.
-                    with stdout_lock:
-                        print("Remove host from database: {}".format(activity[0]))
-                    database_remove_host(activity[0])
             try:
                 message = r.receive_data()
-                process_message(message)
+                dispatch(message)
             except queue.Empty:
                 continue
-            except:
-                with stdout_lock:
-                    print("Unexpected error:", sys.exec_info()[0])
+            except Exception:
+                log.exception("Unexpected error")
     except KeyboardInterrupt:
         with stdout_lock:
             print("Goodbye!")
     except:
-        with stdout_lock:
-            print("Unexpected error:", sys.exec_info()[0])
+        log.exception("Unexpected error")
     finally:
         r.close()
+        file_directory.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        if log_listener is not None:
+            log_listener.stop()
         os._exit(1)
 
 if __name__ == "__main__":
-    init_database()
+    parser = argparse.ArgumentParser(description="P2P directory server.")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="run the RDT layer on the asyncio transport")
+    parser.add_argument("--keep-database", action="store_true",
+                        help="keep the shared files from the last run, migrating an older database")
+    parser.add_argument("--backend", choices=["sqlite", "memory"], default=directory_backend,
+                        help="where to keep the directory of shared files")
+    parser.add_argument("--handlers", type=int, default=handler_workers,
+                        help="number of threads handling client messages")
+    parser.add_argument("--handler-queue", type=int, default=handler_queue_size,
+                        help="messages waiting per handler before the server stops receiving")
+    parser.add_argument("--message-queue", type=int, default=rdt_message_queue_size,
+                        help="received messages waiting before clients must retransmit")
+    parser.add_argument("--host-timeout", type=float, default=host_timeout,
+                        help="seconds after which a silent host's files are removed")
+    parser.add_argument("--metrics-port", type=int, default=metrics_port,
+                        help="serve metrics over HTTP on this localhost port")
+    parser.add_argument("--verbose", action="store_true",
+                        help="also log every message sent")
+    args = parser.parse_args()
+    metrics_port = args.metrics_port
+    verbose = args.verbose
+    host_timeout = activity_tracker.timeout = args.host_timeout
+    handler_workers = args.handlers
+    handler_queue_size = args.handler_queue
+    if args.backend != directory_backend:
+        directory_backend = args.backend
+        file_directory = make_directory(directory_backend)
+    if args.asyncio or args.message_queue != rdt_message_queue_size:
+        rdt_message_queue_size = args.message_queue
+        r.close()
+        r = make_rdt(args.asyncio)
+    init_database(args.keep_database)
     server(listen_port)
@@ -54,23 +54,29 @@ class ServerMsg(object):
         self.status_phrase = "ERROR"
         self.body = "{} {}\r\n".format(method, error_msg)
 
-    def queryresponse(self, results_list):
+    def queryresponse(self, results_list, offset=None, total=None):
         """
         Acknowledges receipt of QUERY message and returns the query results. If there
         are no results, an ERROR message is returned with QUERY as the method.
         Note: This response uses two consecutive value lines per query match.
-    
+
         Arguments:
         results_list -- List of query results in the format:
                         (hostid, host_ip_addr, filename, filesize)
-    
+        offset -- For a paged QUERY, the index of the first result of this page
+                  among all matches. None for an unpaged QUERY.
+        total -- For a paged QUERY, the number of matches over all pages.
+
         """
         self.status_code = "800"
         self.status_phrase = "QUERYRESPONSE"
-        self.body = ""
-        for line in results_list:
-            self.body = "{}{} {}\r\n{} {}\r\n".format(self.body, line[0], line[1], line[2], line[3])
-    
+        lines = []
+        if offset is not None:
+            lines.append("{} {}\r\n".format(offset, total))
+        lines.extend("{} {}\r\n{} {}\r\n".format(line[0], line[1], line[2], line[3])
+                     for line in results_list)
+        self.body = "".join(lines)
+
     def __repr__(self):
         self.message = "{} {}\r\n{}\r\n".format(self.status_code, self.status_phrase, self.body)
     